@@ -22,13 +22,39 @@ import tkinter
 import speech_recognition as sr
 import chess
 import pyautogui
+import requests
 
 sys.path.append(os.path.join(os.getcwd(), r'chessfenbot'))
 import tensorflow_chessbot
+import prediction_server
 import chessboard_finder
-from helper_functions import shortenFEN
+import caching
 
 LOG_LEVEL = logging.DEBUG
+# Piece classifier models in order of preference, (backend, model path). The
+# NumPy and TFLite models don't need TensorFlow to be imported and the
+# optimized frozen graph runs fewer ops, but they have to be made first with
+# chessfenbot/export_model.py
+PREDICTOR_MODELS = [
+        ('numpy', 'chessfenbot/saved_models/cf_v1.0.npz'),
+        ('tflite', 'chessfenbot/saved_models/cf_v1.0.tflite'),
+        ('tf', 'chessfenbot/saved_models/frozen_graph_optimized.pb'),
+        ('tf', 'chessfenbot/saved_models/frozen_graph.pb')
+        ]
+# Keep the piece classifier light next to a running chess client: threads per
+# op, ops run in parallel, and optional list of CPU ids to pin the service to
+PREDICTOR_INTRA_OP_THREADS = 2
+PREDICTOR_INTER_OP_THREADS = 1
+PREDICTOR_CPU_AFFINITY = None
+# Share the model of a prediction server if one is running here, set to None
+# to always load the model in this process
+PREDICTION_SERVER = prediction_server.DEFAULT_SERVER_ADDRESS
+# Tiles seen on earlier screenshots reuse their classification, optionally
+# also kept in a file shared with other processes
+TILE_CACHE_ENTRIES = 4096
+TILE_CACHE_PATH = None
+# Tiles classified with less certainty are re-cropped and classified again
+REFINE_CERTAINTY = 0.9
 GCP_SPEECH_LANGUAGE = "en-US"
 SPEECH_API_PHRASES = [
         "black",
@@ -158,8 +184,9 @@ class CDSService(object):
         
         ## Board detection
         self.board_corners = [0, 0, 0, 0]
-        self.predictor = tensorflow_chessbot.ChessboardPredictor(
-                frozen_graph_path='chessfenbot/saved_models/frozen_graph.pb')
+        self.predictor = self._init_predictor()
+        # Unchanged screenshots reuse the corners found last time
+        self.finder_cache = caching.FinderCache(max_entries=64)
         
         ## Speech recognition
         self.recognizer = sr.Recognizer()
@@ -172,6 +199,35 @@ class CDSService(object):
         self.window = self._init_gui_window()
 
 
+    def _init_predictor(self):
+        """
+        Connect to PREDICTION_SERVER if it's running, else load the first
+        available model in PREDICTOR_MODELS
+        """
+        if PREDICTION_SERVER:
+            try:
+                return prediction_server.PredictionClient(PREDICTION_SERVER)
+            except requests.exceptions.RequestException:
+                self.logger.info('No prediction server at %s, loading model'
+                        % PREDICTION_SERVER)
+        for backend, model_path in PREDICTOR_MODELS:
+            if os.path.exists(model_path) and os.path.getsize(model_path) > 0:
+                self.logger.info('Using %s model %s' % (backend, model_path))
+                predictor = tensorflow_chessbot.ChessboardPredictor(
+                        backend=backend, model_path=model_path,
+                        intra_op_threads=PREDICTOR_INTRA_OP_THREADS,
+                        inter_op_threads=PREDICTOR_INTER_OP_THREADS,
+                        cpu_affinity=PREDICTOR_CPU_AFFINITY,
+                        tile_cache=caching.TileCache(TILE_CACHE_ENTRIES,
+                                                     TILE_CACHE_PATH))
+                self.logger.info('Predictor latency cold %.1f ms, warm %.1f ms'
+                        % (1000 * predictor.cold_latency,
+                           1000 * predictor.warm_latency))
+                return predictor
+        raise IOError('No piece classifier model found in ' +
+                      ', '.join(path for _, path in PREDICTOR_MODELS))
+
+
     def _init_gui_window(self):
         """
         Initialize the tkinter window for the GUI
@@ -257,23 +313,25 @@ class CDSService(object):
         self.logger.debug('START set_board_from_screen')
         screenshot = pyautogui.screenshot()
         tiles = None
-        tiles, corners = chessboard_finder.findGrayscaleTilesInImage(screenshot)
+        tiles, corners = chessboard_finder.findGrayscaleTilesInImage(
+                screenshot, cache=self.finder_cache)
         if(tiles is not None):
-            fen, tile_certainties = self.predictor.getPrediction(tiles)
-            fen = shortenFEN(fen)
-            self.chess_board.set_board_fen(fen)
+            prediction = self.predictor.refinePrediction(
+                    self.predictor.getPrediction(tiles), screenshot, corners,
+                    REFINE_CERTAINTY)
+            self.chess_board.set_board_fen(prediction.short_fen)
             self.board_corners = corners
             self.logger.info('SUCCESS Got board.')
-            self.logger.debug('FEN is ' + fen)
+            self.logger.debug('FEN is ' + prediction.short_fen)
             self.logger.debug('Corners are ' + str(corners))
             
-            certainty = tile_certainties.min()
             self.logger.debug('Per-tile certainty:')
-            self.logger.debug(tile_certainties)
+            self.logger.debug(prediction.tile_certainties)
             self.logger.debug("Certainty range [%g - %g], Avg: %g" % (
-                    tile_certainties.min(), tile_certainties.max(), 
-                    tile_certainties.mean()))
-            self.logger.debug("Final Certainty: %.1f%%" % (certainty*100))
+                    prediction.certainty, prediction.max_certainty,
+                    prediction.mean_certainty))
+            self.logger.debug("Final Certainty: %.1f%%" %
+                    (prediction.certainty*100))
         else:
             self.logger.info('FAIL No tiles detected.')
         self.logger.debug('END set_board_from_screen')
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# usage: benchmark.py [-h] {precheck,batch,empty,bot} ...
+#
+# Measure speed and accuracy of parts of the chessboard pipeline on local data
+#
+# positional arguments:
+#   {precheck,batch,empty,bot}
+#     precheck  False-reject rate and speedup of the thumbnail precheck
+#     batch     Predictor throughput versus number of boards per session call
+#     empty     Accuracy and speedup of the empty square fast path
+#     bot       Time the bot's reply pipeline on a list of image urls
+#
+# optional arguments:
+#   -h, --help  show this help message and exit
+#
+# The precheck benchmark expects a labeled corpus folder laid out as
+#   corpus/board/*.png|jpg|gif     images that contain a chessboard
+#   corpus/no_board/*.png|jpg|gif  images that don't
+#
+# The batch benchmark runs on tiles from --filepath (default example_input.png)
+#
+# The empty benchmark runs on every chessboard image in a folder, and counts
+# tiles the fast path labels empty that the network labels as a piece
+#
+# The bot benchmark loads each url in a text file through the image cache,
+# predicts and writes the reply message like chessbot.py. Run it once online
+# to fill --image_cache_dir, downloading --fetch_workers urls at a time before
+# the timed run, then with --offline to replay the same images as fixtures
+# without a network.
+import argparse
+import glob
+import os
+from time import time
+
+import numpy as np
+
+import chessboard_finder
+import helper_image_loading
+
+def getImagePaths(folder):
+  """Return sorted list of png/jpg/gif image paths in folder"""
+  paths = []
+  for ending in ['png', 'jpg', 'jpeg', 'gif']:
+    paths.extend(glob.glob(os.path.join(folder, '*.%s' % ending)))
+  return sorted(paths)
+
+def benchmarkPrecheck(corpus_folder, noise_threshold=8000, margin=0.5,
+                      max_size=128):
+  """Compare the full finder with and without the thumbnail precheck"""
+  labeled = [(path, True) for path in
+               getImagePaths(os.path.join(corpus_folder, 'board'))] + \
+            [(path, False) for path in
+               getImagePaths(os.path.join(corpus_folder, 'no_board'))]
+  if not labeled:
+    print("No images found in %s/board or %s/no_board" % (
+      corpus_folder, corpus_folder))
+    return
+
+  num_boards = 0
+  num_boards_rejected = 0 # Labeled boards rejected by precheck
+  num_found = 0
+  num_found_rejected = 0 # Corners found by full finder but precheck rejects
+  num_non_boards = 0
+  num_non_boards_rejected = 0
+  time_full = 0.0 # Finder only, on every image
+  time_prechecked = 0.0 # Precheck on every image, finder on ones that pass
+
+  for path, is_board in labeled:
+    img = helper_image_loading.loadImageFromPath(path)
+    img.load()
+
+    a = time()
+    passed = chessboard_finder.precheckChessboard(
+      img, noise_threshold, max_size=max_size, margin=margin)
+    t_precheck = time() - a
+
+    a = time()
+    img_arr = np.asarray(img.convert("L"), dtype=np.float32)
+    corners = chessboard_finder.findChessboardCorners(
+      img_arr, noise_threshold, precheck=False)
+    t_finder = time() - a
+
+    time_full += t_finder
+    time_prechecked += t_precheck + (t_finder if passed else 0.0)
+
+    if is_board:
+      num_boards += 1
+      num_boards_rejected += not passed
+    else:
+      num_non_boards += 1
+      num_non_boards_rejected += not passed
+    if corners is not None:
+      num_found += 1
+      num_found_rejected += not passed
+
+    if is_board and not passed:
+      print("\tFalse reject: %s" % path)
+
+  print("---")
+  print("%d images (%d board, %d no board)" % (
+    len(labeled), num_boards, num_non_boards))
+  print("False-reject rate on labeled boards: %d/%d (%.2f%%)" % (
+    num_boards_rejected, num_boards,
+    100.0 * num_boards_rejected / max(1, num_boards)))
+  print("Rejected images where full finder found corners: %d/%d (%.2f%%)" % (
+    num_found_rejected, num_found,
+    100.0 * num_found_rejected / max(1, num_found)))
+  print("Non-boards rejected early: %d/%d (%.2f%%)" % (
+    num_non_boards_rejected, num_non_boards,
+    100.0 * num_non_boards_rejected / max(1, num_non_boards)))
+  print("Finder only: %.3fs, with precheck: %.3fs, speedup %.2fx" % (
+    time_full, time_prechecked, time_full / max(time_prechecked, 1e-9)))
+
+def loadBoardTiles(filepath):
+  """Return 64x1024 tiles of the chessboard in an image file"""
+  img = helper_image_loading.loadImageFromPath(filepath)
+  tiles, _ = chessboard_finder.findGrayscaleTilesInImage(img)
+  if tiles is None:
+    raise Exception('Couldn\'t find chessboard in %s' % filepath)
+  return tiles
+
+def timeCalls(fn, repeats):
+  """Return average seconds per call of fn after one untimed call"""
+  fn()
+  a = time()
+  for _ in range(repeats):
+    fn()
+  return (time() - a) / repeats
+
+def benchmarkBatch(predictor, tiles, batch_sizes=(1, 2, 4, 8, 16, 32, 64),
+                   repeats=10):
+  """Print boards/second for getPredictions on batches of boards, compared to
+  calling getPrediction once per board. The batches repeat one board, so the
+  predictor should not dedupe tiles or use a tile cache, or this would time
+  those instead of batching."""
+  print("Batch | one call (boards/s) | per board calls (boards/s) | speedup")
+  for batch_size in batch_sizes:
+    tiles_list = [tiles] * batch_size
+    t_batched = timeCalls(lambda: predictor.getPredictions(tiles_list), repeats)
+    t_serial = timeCalls(
+      lambda: [predictor.getPrediction(t) for t in tiles_list], repeats)
+    print("%5d | %19.1f | %26.1f | %6.2fx" % (batch_size,
+      batch_size / t_batched, batch_size / t_serial, t_serial / t_batched))
+
+def benchmarkEmptyFastPath(predictor, image_paths, repeats=5):
+  """Print fraction of tiles skipped by the empty square fast path, how many
+  of those the network would have labeled as a piece, and time per board"""
+  import tensorflow_chessbot
+  num_boards = 0
+  num_tiles = 0
+  num_skipped = 0
+  num_wrong = 0 # Skipped tiles the network labels as a piece
+  time_full = 0.0
+  time_fast = 0.0
+  for path in image_paths:
+    img = helper_image_loading.loadImageFromPath(path)
+    tiles, _ = chessboard_finder.findGrayscaleTilesInImage(img)
+    if tiles is None:
+      print("\tNo chessboard found: %s" % path)
+      continue
+    rows = tensorflow_chessbot.getTileRows(tiles)
+    empty = tensorflow_chessbot.getEmptyTileMask(rows)
+    labels = predictor.backend.run(rows).argmax(axis=1)
+    num_boards += 1
+    num_tiles += len(rows)
+    num_skipped += empty.sum()
+    num_wrong += (labels[empty] != 0).sum()
+    if (labels[empty] != 0).any():
+      print("\t%d skipped tiles labeled as pieces: %s" % (
+        (labels[empty] != 0).sum(), path))
+
+    predictor.empty_fast_path = False
+    time_full += timeCalls(lambda: predictor.getPrediction(tiles), repeats)
+    predictor.empty_fast_path = True
+    time_fast += timeCalls(lambda: predictor.getPrediction(tiles), repeats)
+
+  if not num_boards:
+    print("No chessboards found")
+    return
+  print("---")
+  print("%d boards, %d/%d tiles skipped (%.1f%%)" % (
+    num_boards, num_skipped, num_tiles, 100.0 * num_skipped / num_tiles))
+  print("Skipped tiles the network labels as a piece: %d (%.2f%% of tiles)" % (
+    num_wrong, 100.0 * num_wrong / num_tiles))
+  print("Per board: %.1f ms full network, %.1f ms with fast path, speedup %.2fx" % (
+    1000 * time_full / num_boards, 1000 * time_fast / num_boards,
+    time_full / max(time_fast, 1e-9)))
+
+def prefetchURLs(urls, max_workers=helper_image_loading.POOL_SIZE):
+  """Download urls concurrently into the image cache, printing failures"""
+  a = time()
+  # Same size limit as ChessboardPredictor.makePrediction
+  results = helper_image_loading.loadImagesFromURLs(urls, 2000000, max_workers)
+  for url, (_, _, error) in zip(urls, results):
+    if error is not None:
+      print("\tCouldn't fetch %s: %s" % (url, error))
+  print("Fetched %d/%d urls in %.2f s with %d threads" % (
+    sum(error is None for _, _, error in results), len(urls), time() - a,
+    max_workers))
+
+def benchmarkBot(predictor, urls):
+  """Print time to load, predict and write a reply for each url, and totals"""
+  from helper_functions import shortenFEN
+  from helper_functions_chessbot import generateMessage, getSideToPlay
+  num_replies = 0
+  time_total = 0.0
+  for url in urls:
+    a = time()
+    fen, certainty, visualize_link = predictor.makePrediction(url)
+    if fen is not None:
+      fen = shortenFEN(fen)
+      generateMessage(fen, certainty, getSideToPlay('', fen), visualize_link)
+      num_replies += 1
+    seconds = time() - a
+    time_total += seconds
+    print("\t%.1f ms %s %s" % (1000 * seconds, fen, url))
+
+  print("---")
+  print("%d urls, %d replies, %.1f ms per url, %.2f s total" % (
+    len(urls), num_replies, 1000 * time_total / max(1, len(urls)), time_total))
+
+if __name__ == '__main__':
+  np.set_printoptions(suppress=True, precision=3)
+  parser = argparse.ArgumentParser(description='Measure speed and accuracy of parts of the chessboard pipeline on local data')
+  subparsers = parser.add_subparsers(dest='command')
+
+  parser_precheck = subparsers.add_parser('precheck',
+    help='False-reject rate and speedup of the thumbnail precheck')
+  parser_precheck.add_argument('corpus_folder', help='Folder with board/ and no_board/ subfolders')
+  parser_precheck.add_argument('--noise_threshold', type=float, default=8000)
+  parser_precheck.add_argument('--margin', type=float, default=0.5,
+    help='Fraction of noise_threshold the thumbnail must reach')
+  parser_precheck.add_argument('--max_size', type=int, default=128,
+    help='Max thumbnail side in pixels')
+
+  parser_batch = subparsers.add_parser('batch',
+    help='Predictor throughput versus number of boards per session call')
+  parser_batch.add_argument('--filepath', default='example_input.png',
+    help='Chessboard image to take tiles from')
+  parser_batch.add_argument('--frozen_graph_path',
+    default='saved_models/frozen_graph.pb')
+  parser_batch.add_argument('--batch_sizes', default='1,2,4,8,16,32,64',
+    help='Comma separated numbers of boards per call')
+  parser_batch.add_argument('--repeats', type=int, default=10)
+
+  parser_empty = subparsers.add_parser('empty',
+    help='Accuracy and speedup of the empty square fast path')
+  parser_empty.add_argument('image_folder', help='Folder of chessboard images')
+  parser_empty.add_argument('--backend', default='tf')
+  parser_empty.add_argument('--model_path')
+  parser_empty.add_argument('--repeats', type=int, default=5)
+
+  parser_bot = subparsers.add_parser('bot',
+    help='Time the bot\'s reply pipeline on a list of image urls')
+  parser_bot.add_argument('url_file', help='Text file with one image url per line')
+  parser_bot.add_argument('--image_cache_dir', default='image_cache',
+    help='Folder to cache downloaded images in')
+  parser_bot.add_argument('--offline', action='store_true',
+    help='Only use images already in --image_cache_dir, never download')
+  parser_bot.add_argument('--fetch_workers', type=int,
+    default=helper_image_loading.POOL_SIZE,
+    help='Urls downloaded at a time into the image cache before timing')
+  parser_bot.add_argument('--backend', default='tf')
+  parser_bot.add_argument('--model_path')
+
+  args = parser.parse_args()
+  if args.command == 'precheck':
+    benchmarkPrecheck(args.corpus_folder, args.noise_threshold, args.margin,
+                      args.max_size)
+  elif args.command == 'batch':
+    import tensorflow_chessbot
+    # Every board in a batch is the same, run them all through the network
+    predictor = tensorflow_chessbot.ChessboardPredictor(args.frozen_graph_path,
+                                                        dedupe_tiles=False)
+    benchmarkBatch(predictor, loadBoardTiles(args.filepath),
+                   [int(n) for n in args.batch_sizes.split(',')], args.repeats)
+    predictor.close()
+  elif args.command == 'empty':
+    import tensorflow_chessbot
+    predictor = tensorflow_chessbot.ChessboardPredictor(
+      backend=args.backend, model_path=args.model_path)
+    benchmarkEmptyFastPath(predictor, getImagePaths(args.image_folder),
+                           args.repeats)
+    predictor.close()
+  elif args.command == 'bot':
+    import caching
+    import tensorflow_chessbot
+    with open(args.url_file) as f:
+      urls = [line.strip() for line in f if line.strip()]
+    image_cache = caching.ImageCache(args.image_cache_dir, offline=args.offline)
+    helper_image_loading.setImageCache(image_cache)
+    if not args.offline:
+      prefetchURLs(urls, args.fetch_workers)
+    predictor = tensorflow_chessbot.ChessboardPredictor(
+      backend=args.backend, model_path=args.model_path)
+    benchmarkBot(predictor, urls)
+    predictor.close()
+    print(image_cache)
+  else:
+    parser.print_help()
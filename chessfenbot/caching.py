@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+#
+# Caches used to skip repeated work on images that were already processed
+#
+# LRUCache is an in-memory least recently used cache, DiskCache is a folder of
+# files evicted least recently used once it grows past a size limit, both
+# keep hit/miss counts. FinderCache puts them together to remember chessboard
+# corners found for an image, keyed by a hash of its decoded pixels.
+#
+# URLCache remembers what page urls resolved to (imgur pages to the image
+# url), with entries expiring after a TTL, in the same two tiers.
+#
+# ImageCache keeps downloaded image bytes on disk named by a hash of their
+# content, so the same image linked from several urls is stored once, plus a
+# url to content hash index with a TTL. Offline it serves as a fixture store
+# that never expires and is never refreshed.
+#
+# TileCache remembers the network's probabilities for tiles, keyed by a
+# fingerprint of the quantized tile pixels, in an LRUCache and optionally a
+# SharedTileStore, a fixed size memory-mapped hash table file several
+# processes can read and write at once.
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from time import time
+
+import numpy as np
+
+def hashArray(arr, extra=b''):
+  """Return hex digest of a fast hash over the shape, dtype and buffer of arr"""
+  h = hashlib.blake2b(digest_size=16)
+  h.update(('%s %s ' % (arr.shape, arr.dtype)).encode('ascii'))
+  h.update(extra)
+  h.update(np.ascontiguousarray(arr).data)
+  return h.hexdigest()
+
+class LRUCache(object):
+  """In-memory least recently used cache holding up to max_entries values,
+  safe to share between threads"""
+  def __init__(self, max_entries=1024):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def get(self, key, default=None):
+    """Return cached value for key and mark it recently used, else default"""
+    with self.lock:
+      if key not in self.entries:
+        self.misses += 1
+        return default
+      self.hits += 1
+      self.entries.move_to_end(key)
+      return self.entries[key]
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = value
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+class DiskCache(object):
+  """Folder of files named by key, least recently used files are deleted once
+  the total size goes over max_bytes. Safe to share between threads and
+  processes."""
+  def __init__(self, cache_dir, max_bytes=64*1024*1024):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock() # Guards total_bytes
+    self.hits = 0
+    self.misses = 0
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    self.total_bytes = sum(os.path.getsize(path) for path in self._paths())
+
+  def _paths(self):
+    return [os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir) if not name.startswith('.')]
+
+  def _path(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def contains(self, key):
+    """Return whether key is cached, without reading it or counting a hit"""
+    return os.path.exists(self._path(key))
+
+  def touch(self, key):
+    """Mark key recently used, without reading it"""
+    try:
+      os.utime(self._path(key), None)
+    except OSError:
+      pass # Removed by another process
+
+  def get(self, key):
+    """Return cached bytes for key and mark it recently used, else None"""
+    path = self._path(key)
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+    except (IOError, OSError):
+      self.misses += 1
+      return None
+    self.hits += 1
+    # Modification time tracks recency for eviction
+    self.touch(key)
+    return data
+
+  def put(self, key, data):
+    path = self._path(key)
+    # Write then rename so other threads and processes never read a partial
+    # file, the temporary file is unique even when they store the same key
+    fd, tmp_path = tempfile.mkstemp(prefix='.', dir=self.cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    with self.lock:
+      try:
+        self.total_bytes -= os.path.getsize(path)
+      except OSError:
+        pass # New key
+      os.replace(tmp_path, path)
+      self.total_bytes += len(data)
+      over = self.total_bytes > self.max_bytes
+    if over:
+      self.evict()
+
+  def evict(self):
+    """Delete least recently used files until under max_bytes"""
+    with self.lock:
+      entries = []
+      for path in self._paths():
+        try:
+          entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        except OSError:
+          pass # Removed by another process
+      entries.sort()
+      self.total_bytes = sum(size for _, size, _ in entries)
+      for _, size, path in entries:
+        if self.total_bytes <= self.max_bytes:
+          break
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+        self.total_bytes -= size
+
+def formatStats(name, hits, misses, detail=''):
+  """Return one line summary of cache hit/miss counts"""
+  total = hits + misses
+  return "%s: %d hits%s, %d misses, %.1f%% hit rate" % (
+    name, hits, detail, misses, 100.0 * hits / max(1, total))
+
+class FinderCache(object):
+  """Cache of chessboard corners, or the verdict that there is no chessboard,
+  keyed by a hash of the decoded grayscale pixel buffer.
+
+  Keeps an in-memory LRU, and if cache_dir is given a size limited on-disk
+  tier that persists across runs and can be shared between processes."""
+  def __init__(self, max_entries=1024, cache_dir=None,
+               max_disk_bytes=16*1024*1024):
+    self.memory = LRUCache(max_entries)
+    self.disk = DiskCache(cache_dir, max_disk_bytes) if cache_dir else None
+
+  def getKey(self, img_arr, noise_threshold=8000):
+    """Return cache key for a grayscale image array and finder settings"""
+    return hashArray(img_arr, ('%g' % noise_threshold).encode('ascii'))
+
+  def get(self, key):
+    """Return (hit, corners), corners is None for a cached no chessboard"""
+    corners = self.memory.get(key, self)
+    if corners is not self:
+      return True, corners
+
+    if self.disk is not None:
+      data = self.disk.get(key)
+      if data is not None:
+        corners = json.loads(data.decode('ascii'))
+        if corners is not None:
+          corners = np.array(corners)
+        self.memory.put(key, corners)
+        return True, corners
+    return False, None
+
+  def put(self, key, corners):
+    self.memory.put(key, corners)
+    if self.disk is not None:
+      value = None if corners is None else [int(c) for c in corners]
+      self.disk.put(key, json.dumps(value).encode('ascii'))
+
+  @property
+  def hits(self):
+    return self.memory.hits + (self.disk.hits if self.disk else 0)
+
+  @property
+  def misses(self):
+    return self.disk.misses if self.disk else self.memory.misses
+
+  def getStats(self):
+    """Return dict of hit/miss counts"""
+    return {
+      'memory_hits': self.memory.hits,
+      'disk_hits': self.disk.hits if self.disk else 0,
+      'misses': self.misses,
+      'memory_entries': len(self.memory),
+      'disk_bytes': self.disk.total_bytes if self.disk else 0,
+    }
+
+  def __str__(self):
+    stats = self.getStats()
+    return formatStats('Finder cache', self.hits, self.misses,
+      ' (%d memory, %d disk)' % (stats['memory_hits'], stats['disk_hits']))
+
+class URLCache(object):
+  """Cache of page url to resolved url (like an imgur page to its image),
+  entries expire ttl seconds after they were resolved.
+
+  Keeps an in-memory LRU, and if cache_dir is given a size limited on-disk
+  tier that persists across runs and can be shared between processes."""
+  def __init__(self, max_entries=4096, cache_dir=None, ttl=7*24*3600,
+               max_disk_bytes=4*1024*1024):
+    self.memory = LRUCache(max_entries)
+    self.disk = DiskCache(cache_dir, max_disk_bytes) if cache_dir else None
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+
+  def getKey(self, url):
+    return hashlib.blake2b(url.encode('utf-8'), digest_size=16).hexdigest()
+
+  def get(self, url):
+    """Return resolved url cached for url if it hasn't expired, else None"""
+    key = self.getKey(url)
+    entry = self.memory.get(key)
+    if entry is None and self.disk is not None:
+      data = self.disk.get(key)
+      if data is not None:
+        entry = json.loads(data.decode('utf-8'))
+        # Keys are hashes, make sure the file is for this url
+        entry = tuple(entry[1:]) if entry[0] == url else None
+        if entry is not None:
+          self.memory.put(key, entry)
+    if entry is None or time() - entry[1] > self.ttl:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return entry[0]
+
+  def put(self, url, resolved_url):
+    key = self.getKey(url)
+    resolved_time = time()
+    self.memory.put(key, (resolved_url, resolved_time))
+    if self.disk is not None:
+      self.disk.put(key, json.dumps(
+        [url, resolved_url, resolved_time]).encode('utf-8'))
+
+  def getStats(self):
+    """Return dict of hit/miss counts"""
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'memory_entries': len(self.memory),
+      'disk_bytes': self.disk.total_bytes if self.disk else 0,
+    }
+
+  def __str__(self):
+    return formatStats('URL cache', self.hits, self.misses)
+
+class ImageCache(object):
+  """On-disk cache of downloaded image bytes for urls.
+
+  Images are files in cache_dir/images named by a hash of their bytes, evicted
+  least recently used past max_bytes. cache_dir/urls maps each url to the
+  content hash and the url the image was actually downloaded from (ex. the
+  image behind an imgur page), entries expire ttl seconds after the download.
+
+  With offline the ttl is ignored, and callers should treat a miss as a
+  failed download instead of fetching the url, so a cache filled by an
+  online run replays the same images without a network."""
+  def __init__(self, cache_dir, ttl=7*24*3600, max_bytes=256*1024*1024,
+               max_index_bytes=8*1024*1024, offline=False):
+    self.images = DiskCache(os.path.join(cache_dir, 'images'), max_bytes)
+    self.index = DiskCache(os.path.join(cache_dir, 'urls'), max_index_bytes)
+    self.ttl = ttl
+    self.offline = offline
+    self.hits = 0
+    self.misses = 0
+    self.expired = 0 # Misses on urls cached longer than ttl ago
+    self.evicted = 0 # Misses on urls whose image was evicted
+    self.bytes_hit = 0
+
+  def getKey(self, url):
+    return hashlib.blake2b(url.encode('utf-8'), digest_size=16).hexdigest()
+
+  def getContentKey(self, data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+  def get(self, url):
+    """Return (image bytes, url they were downloaded from) cached for url,
+    or (None, None) if it isn't cached or has expired"""
+    data = self.index.get(self.getKey(url))
+    entry = json.loads(data.decode('utf-8')) if data is not None else None
+    # Keys are hashes, make sure the entry is for this url
+    if entry is None or entry[0] != url:
+      self.misses += 1
+      return None, None
+    _, content_key, resolved_url, fetched_time = entry
+    if not self.offline and time() - fetched_time > self.ttl:
+      self.expired += 1
+      self.misses += 1
+      return None, None
+    data = self.images.get(content_key)
+    if data is None:
+      self.evicted += 1
+      self.misses += 1
+      return None, None
+    self.hits += 1
+    self.bytes_hit += len(data)
+    return data, resolved_url
+
+  def put(self, url, data, resolved_url=None):
+    """Cache image bytes data downloaded for url, from resolved_url if the
+    url was redirected elsewhere"""
+    content_key = self.getContentKey(data)
+    # Already stored for another url, only refresh its recency
+    if self.images.contains(content_key):
+      self.images.touch(content_key)
+    else:
+      self.images.put(content_key, data)
+    self.index.put(self.getKey(url), json.dumps(
+      [url, content_key, resolved_url or url, time()]).encode('utf-8'))
+
+  def getStats(self):
+    """Return dict of hit/miss counts and disk usage"""
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'expired': self.expired,
+      'evicted': self.evicted,
+      'bytes_hit': self.bytes_hit,
+      'image_bytes': self.images.total_bytes,
+      'index_bytes': self.index.total_bytes,
+    }
+
+  def __str__(self):
+    stats = self.getStats()
+    return formatStats('Image cache', self.hits, self.misses,
+      ' (%d KB not downloaded)' % (stats['bytes_hit'] // 1024)) + \
+      ', %d expired, %d evicted, %d KB on disk' % (
+        stats['expired'], stats['evicted'], stats['image_bytes'] // 1024)
+
+class SharedTileStore(object):
+  """Fixed size hash table of tile fingerprint to 13 probabilities in a
+  memory-mapped file, shared by every process that opens the same path.
+
+  A new file holds max_bytes // slot size slots, an existing file keeps the
+  number of slots it was made with. A key can live in any of
+  probe_slots consecutive slots starting at its hash, when they are all
+  taken the least recently used one is overwritten, so the file never grows.
+  Concurrent writers to the same slot can lose an entry, but a slot's key is
+  cleared while it is rewritten and checked again after reading, so readers
+  never get probabilities of a different tile."""
+  SLOT_DTYPE = np.dtype([('key', 'V16'), ('last_used', '<u4'),
+                         ('probabilities', '<f4', (13,))])
+
+  def __init__(self, path, max_bytes=16*1024*1024, probe_slots=8):
+    self.path = path
+    self.probe_slots = probe_slots
+    slot_bytes = self.SLOT_DTYPE.itemsize
+    if os.path.exists(path):
+      # Use the existing file whatever its size, so every process mapping it
+      # agrees on the number of slots, even if they were given other max_bytes
+      size = os.path.getsize(path)
+      if size % slot_bytes or size // slot_bytes < probe_slots:
+        raise Exception('Tile store %s is %d bytes, not a whole number of at '
+                        'least %d %d byte slots' % (path, size, probe_slots,
+                                                    slot_bytes))
+      self.num_slots = size // slot_bytes
+    else:
+      self.num_slots = max(probe_slots, max_bytes // slot_bytes)
+      # Create zeroed (all empty) file then rename so other processes never
+      # map a partial one
+      tmp_path = '%s.%d' % (path, os.getpid())
+      with open(tmp_path, 'wb') as f:
+        f.truncate(self.num_slots * slot_bytes)
+      os.rename(tmp_path, path)
+    self.slots = np.memmap(path, dtype=self.SLOT_DTYPE, mode='r+',
+                           shape=(self.num_slots,))
+    self.hits = 0
+    self.misses = 0
+
+  def _probe(self, key):
+    start = int.from_bytes(key[:8], 'little') % self.num_slots
+    return [(start + i) % self.num_slots for i in range(self.probe_slots)]
+
+  def get(self, key):
+    """Return 13 probabilities for 16 byte key, else None"""
+    key = np.void(key)
+    for i in self._probe(key.tobytes()):
+      slot = self.slots[i]
+      if slot['key'] == key:
+        probabilities = slot['probabilities'].copy()
+        if self.slots[i]['key'] == key: # Not rewritten while reading
+          self.slots['last_used'][i] = int(time())
+          self.hits += 1
+          return probabilities
+    self.misses += 1
+    return None
+
+  def put(self, key, probabilities):
+    empty = np.void(bytes(16))
+    key = np.void(key)
+    probe = self._probe(key.tobytes())
+    keys = self.slots['key'][probe]
+    if (keys == key).any():
+      i = probe[int(np.argmax(keys == key))]
+    elif (keys == empty).any():
+      i = probe[int(np.argmax(keys == empty))]
+    else:
+      i = probe[int(np.argmin(self.slots['last_used'][probe]))]
+    self.slots['key'][i] = empty
+    self.slots['probabilities'][i] = probabilities
+    self.slots['last_used'][i] = int(time())
+    self.slots['key'][i] = key
+
+  def __len__(self):
+    return int((self.slots['key'] != np.void(bytes(16))).sum())
+
+  def flush(self):
+    self.slots.flush()
+
+class TileCache(object):
+  """Cache of network output probabilities per tile.
+
+  Tiles are keyed by a hash of their pixels quantized to 8 - quantize_bits
+  bits, so tiles differing only by resampling noise share an entry, plus a
+  model tag so different models never share entries. Keeps an in-memory LRU,
+  and if store_path is given a SharedTileStore of at most max_disk_bytes."""
+  def __init__(self, max_entries=16384, store_path=None,
+               max_disk_bytes=16*1024*1024, quantize_bits=2):
+    self.memory = LRUCache(max_entries)
+    self.store = SharedTileStore(store_path, max_disk_bytes) \
+                 if store_path else None
+    self.quantize_bits = quantize_bits
+
+  def getKeys(self, rows, model_tag=''):
+    """Return list of 16 byte keys for Nx1024 uint8 0-255 or normalized float
+    tile rows, the same tile gets the same key either way"""
+    if rows.dtype == np.uint8:
+      quantized = rows >> self.quantize_bits
+    else:
+      quantized = (np.clip(rows, 0, 1) * 255 + 0.5).astype(np.uint8)
+      quantized >>= self.quantize_bits
+    model_hash = hashlib.blake2b(digest_size=16)
+    model_hash.update(('%s %d ' % (model_tag, self.quantize_bits)).encode('utf-8'))
+    keys = []
+    for row in quantized:
+      h = model_hash.copy()
+      h.update(row.data)
+      keys.append(h.digest())
+    return keys
+
+  def lookup(self, keys):
+    """Return (Nx13 probabilities, boolean mask of keys found)"""
+    probabilities = np.zeros([len(keys), 13], dtype=np.float32)
+    found = np.zeros(len(keys), dtype=bool)
+    for i, key in enumerate(keys):
+      value = self.memory.get(key)
+      if value is None and self.store is not None:
+        value = self.store.get(key)
+        if value is not None:
+          self.memory.put(key, value)
+      if value is not None:
+        probabilities[i] = value
+        found[i] = True
+    return probabilities, found
+
+  def put(self, keys, probabilities):
+    for key, value in zip(keys, probabilities):
+      value = np.array(value, dtype=np.float32)
+      self.memory.put(key, value)
+      if self.store is not None:
+        self.store.put(key, value)
+
+  @property
+  def hits(self):
+    return self.memory.hits + (self.store.hits if self.store else 0)
+
+  @property
+  def misses(self):
+    return self.store.misses if self.store else self.memory.misses
+
+  def getStats(self):
+    """Return dict of hit/miss counts"""
+    return {
+      'memory_hits': self.memory.hits,
+      'disk_hits': self.store.hits if self.store else 0,
+      'misses': self.misses,
+      'memory_entries': len(self.memory),
+      'disk_entries': len(self.store) if self.store else 0,
+    }
+
+  def __str__(self):
+    stats = self.getStats()
+    return formatStats('Tile cache', self.hits, self.misses,
+      ' (%d memory, %d disk)' % (stats['memory_hits'], stats['disk_hits']))
@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # Pass in image of online chessboard screenshot, returns corners of chessboard
-# usage: chessboard_finder.py [-h] urls [urls ...]
+# usage: chessboard_finder.py [-h] [--processes PROCESSES] [urls [urls ...]]
 
 # Find orthorectified chessboard corners in image
 
 # positional arguments:
-#   urls        Input image urls
+#   urls                   Input image urls
 
 # optional arguments:
-#   -h, --help  show this help message and exit
+#   -h, --help             show this help message and exit
+#   --processes PROCESSES  Number of worker processes (default all cores, 1
+#                          runs serially)
 
 
 # sudo apt-get install libatlas-base-dev for numpy error, see https://github.com/Kitt-AI/snowboy/issues/262
@@ -17,6 +19,9 @@ import numpy as np
 # sudo apt-get install libopenjp2-7 libtiff5
 import PIL.Image
 import argparse
+import functools
+import multiprocessing
+from collections import OrderedDict, deque
 from time import time
 from helper_image_loading import *
 
@@ -39,14 +44,8 @@ def nonmax_suppress_1d(arr, winsize=5):
       _arr[i] = 0
   return _arr
 
-def findChessboardCorners(img_arr_gray, noise_threshold = 8000):
-  # Load image grayscale as an numpy array
-  # Return None on failure to find a chessboard
-  #
-  # noise_threshold: Ratio of standard deviation of hough values along an axis
-  # versus the number of pixels, manually measured  bad trigger images
-  # at < 5,000 and good  chessboards values at > 10,000
-
+def getHoughResponses(img_arr_gray):
+  """Return 1-D amplitude of hough transform of gradients about X & Y axes"""
   # Get gradients, split into positive and inverted negative components 
   gx, gy = np.gradient(img_arr_gray)
   gx_pos = gx.copy()
@@ -60,14 +59,72 @@ def findChessboardCorners(img_arr_gray, noise_threshold = 8000):
   gy_neg[gy_neg<0] = 0
 
   # 1-D ampltitude of hough transform of gradients about X & Y axes
-  num_px = img_arr_gray.shape[0] * img_arr_gray.shape[1]
   hough_gx = gx_pos.sum(axis=1) * gx_neg.sum(axis=1)
   hough_gy = gy_pos.sum(axis=0) * gy_neg.sum(axis=0)
+  return hough_gx, hough_gy
+
+def getHoughNoiseRatio(hough_gx, hough_gy):
+  """Return the weaker normalized standard deviation of the two hough axes"""
+  return min(hough_gx.std() / hough_gx.size, hough_gy.std() / hough_gy.size)
+
+def getGrayThumbnail(img, max_size=128):
+  """Return a small float32 grayscale thumbnail of a PIL image or 2D array,
+  along with the integer downscale factor used to make it"""
+  if isinstance(img, PIL.Image.Image):
+    factor = max(1, int(np.ceil(max(img.size) / float(max_size))))
+    if factor > 1:
+      # Box filter averages every source pixel into the thumbnail once
+      img = img.resize((max(1, img.size[0] // factor),
+                        max(1, img.size[1] // factor)), PIL.Image.BOX)
+    return np.asarray(img.convert("L"), dtype=np.float32), factor
+
+  factor = max(1, int(np.ceil(max(img.shape[:2]) / float(max_size))))
+  if factor == 1:
+    return np.asarray(img, dtype=np.float32), factor
+  # Block mean over factor x factor pixel blocks, dropping the ragged edge
+  h = (img.shape[0] // factor) * factor
+  w = (img.shape[1] // factor) * factor
+  thumb = img[:h, :w].reshape(h // factor, factor, w // factor, factor) \
+    .mean(axis=(1,3), dtype=np.float32)
+  return thumb, factor
+
+def precheckChessboard(img, noise_threshold=8000, max_size=128, margin=0.5):
+  """Cheap early reject for images that contain no chessboard.
+
+  Runs the same hough noise test as findChessboardCorners on a small
+  thumbnail, returns False only if the image clearly has no chessboard"""
+  thumb, factor = getGrayThumbnail(img, max_size)
+
+  # Too small to judge, leave it to the full resolution finder
+  if min(thumb.shape) < 16:
+    return True
+
+  # Downscaling by a factor f shrinks both per-axis gradient sums by ~f
+  # (their product by ~f^2) and the axis length by f, so the normalized
+  # ratio drops by ~f. margin keeps the test conservative to avoid rejecting
+  # real boards whose edges get blurred by the box filter.
+  ratio = getHoughNoiseRatio(*getHoughResponses(thumb)) * factor
+  return ratio >= noise_threshold * margin
+
+def findChessboardCorners(img_arr_gray, noise_threshold = 8000, precheck = True):
+  # Load image grayscale as an numpy array
+  # Return None on failure to find a chessboard
+  #
+  # noise_threshold: Ratio of standard deviation of hough values along an axis
+  # versus the number of pixels, manually measured  bad trigger images
+  # at < 5,000 and good  chessboards values at > 10,000
+  #
+  # precheck: Reject obvious non-chessboards on a thumbnail first, skip if
+  # the caller already ran precheckChessboard
+
+  if precheck and not precheckChessboard(img_arr_gray, noise_threshold):
+    return None
+
+  hough_gx, hough_gy = getHoughResponses(img_arr_gray)
 
   # Check that gradient peak signal is strong enough by
   # comparing normalized standard deviation to threshold
-  if min(hough_gx.std() / hough_gx.size,
-         hough_gy.std() / hough_gy.size) < noise_threshold:
+  if getHoughNoiseRatio(hough_gx, hough_gy) < noise_threshold:
     return None
   
   # Normalize and skeletonize to just local peaks
@@ -246,109 +303,360 @@ def getAllSequences(seq, min_seq_len=7, err_px=5):
         seqs.append(s)
   return seqs
 
-def getChessTilesColor(img, corners):
+# Separable resampling weights keyed by (corners, image size), reused while
+# the chessboard stays in place across frames
+RESAMPLE_CACHE_SIZE = 16
+_resample_cache = OrderedDict()
+
+def getResampleWeights(start, end, size, out_size=256, num_blocks=8,
+                       block=None):
+  """Return bilinear weights that resample pixels [start, end) of an image
+  axis with size pixels to out_size samples.
+
+  Matches PIL's antialiased BILINEAR resize of the cropped span, samples
+  outside of the image are clamped to the nearest edge pixel like padding with
+  np.pad(mode='edge'). start and end may be sub-pixel.
+
+  The weights are banded, so they are returned split into num_blocks row
+  blocks (one per rank or file of the board) as a list of
+  (out_start, out_end, in_start, in_end, matrix), where each block of output
+  samples is matrix.dot(axis[in_start:in_end]). If block is given only that
+  block is built and returned."""
+  lo = int(np.floor(start))
+  hi = int(np.ceil(end))
+  scale = (end - start) / float(out_size)
+  filterscale = max(scale, 1.0)
+  support = filterscale # Triangle filter has a support of 1px
+
+  # Output sample centers in crop coordinates, and the crop pixels they touch
+  block_size = out_size // num_blocks
+  first = 0 if block is None else block * block_size
+  num_out = out_size if block is None else block_size
+  centers = (start - lo) + (np.arange(first, first + num_out) + 0.5) * scale
+  xmin = np.maximum(np.floor(centers - support + 0.5).astype(int), 0)
+  xmax = np.minimum(np.floor(centers + support + 0.5).astype(int), hi - lo)
+  idx = xmin[:,None] + np.arange(int(np.ceil(support)) * 2 + 1)
+
+  weights = 1.0 - np.abs((idx - centers[:,None] + 0.5) / filterscale)
+  weights[(weights < 0) | (idx >= xmax[:,None])] = 0
+  weights /= weights.sum(axis=1, keepdims=True)
+
+  # Clamp out of bounds pixels to the edge instead of padding the image
+  src = np.clip(idx + lo, 0, size - 1)
+  used = weights > 0
+
+  blocks = []
+  for out_start in range(first, first + num_out, block_size):
+    out_end = out_start + block_size
+    block_used = used[out_start - first:out_end - first]
+    block_src = src[out_start - first:out_end - first][block_used]
+    in_start = block_src.min()
+    in_end = block_src.max() + 1
+
+    matrix = np.zeros([block_size, in_end - in_start], dtype=np.float32)
+    rows = np.repeat(np.arange(block_size)[:,None], idx.shape[1], axis=1)
+    np.add.at(matrix, (rows[block_used], block_src - in_start),
+              weights[out_start - first:out_end - first][block_used])
+    blocks.append((out_start, out_end, in_start, in_end, matrix))
+  return blocks if block is None else blocks[0]
+
+def getResampleMatrices(corners, img_shape, out_size=256):
+  """Return (row_blocks, col_blocks) of resampling weights that map the
+  chessboard inside corners to out_size x out_size px, see
+  getResampleWeights. Column matrices are stored transposed, cached by
+  corners and image size."""
+  key = (tuple(corners), tuple(img_shape[:2]), out_size)
+  if key in _resample_cache:
+    _resample_cache.move_to_end(key)
+    return _resample_cache[key]
+
+  row_blocks = getResampleWeights(corners[1], corners[3], img_shape[0], out_size)
+  col_blocks = [(o0, o1, i0, i1, np.ascontiguousarray(matrix.T))
+    for o0, o1, i0, i1, matrix in
+    getResampleWeights(corners[0], corners[2], img_shape[1], out_size)]
+  matrices = (row_blocks, col_blocks)
+
+  _resample_cache[key] = matrices
+  if len(_resample_cache) > RESAMPLE_CACHE_SIZE:
+    _resample_cache.popitem(last=False)
+  return matrices
+
+def resampleChessboard(img, corners, out_size=256):
+  """Return float32 out_size x out_size (x channels) bilinear resampling of the
+  chessboard inside corners, using small matmuls on the cropped view"""
+  if img.ndim == 3:
+    return np.stack([resampleChessboard(img[:,:,c], corners, out_size)
+                     for c in range(img.shape[2])], axis=2)
+
+  row_blocks, col_blocks = getResampleMatrices(corners, img.shape, out_size)
+  x0 = col_blocks[0][2]
+  x1 = col_blocks[-1][3]
+
+  # Rows pass, each block of output rows only reads its band of image rows
+  rows_resampled = np.empty([out_size, x1 - x0], dtype=np.float32)
+  for o0, o1, i0, i1, matrix in row_blocks:
+    crop = img[i0:i1, x0:x1]
+    if crop.dtype != np.float32:
+      crop = crop.astype(np.float32)
+    np.dot(matrix, crop, out=rows_resampled[o0:o1])
+
+  # Columns pass
+  resampled = np.empty([out_size, out_size], dtype=np.float32)
+  for o0, o1, i0, i1, matrix in col_blocks:
+    resampled[:, o0:o1] = rows_resampled[:, i0 - x0:i1 - x0].dot(matrix)
+  return resampled
+
+def toUint8(img):
+  """Round and clip float 0-255 image to uint8"""
+  return np.clip(np.rint(img), 0, 255).astype(np.uint8)
+
+def getChessTilesColor(img, corners, dtype=np.float32):
   # img is a color RGB image
   # corners = (x0, y0, x1, y1) for top-left corner to bot-right corner of board
+  # dtype: float32 for normalized 0-1 tiles or uint8 for 0-255 tiles
   height, width, depth = img.shape
   if depth !=3:
     print("Need RGB color image input")
     return None
 
-  # corners could be outside image bounds, pad image as needed
-  padl_x = max(0, -corners[0])
-  padl_y = max(0, -corners[1])
-  padr_x = max(0, corners[2] - width)
-  padr_y = max(0, corners[3] - height)
-
-  img_padded = np.pad(img, ((padl_y,padr_y),(padl_x,padr_x), (0,0)), mode='edge')
+  # 256x256 px RGB image, 32x32px individual RGB tiles
+  # corners could be outside image bounds, those pixels are clamped to the edge
+  chessboard_img_resized = toUint8(resampleChessboard(img, corners))
 
-  chessboard_img = img_padded[
-    (padl_y + corners[1]):(padl_y + corners[3]), 
-    (padl_x + corners[0]):(padl_x + corners[2]), :]
-
-  # 256x256 px RGB image, 32x32px individual RGB tiles, normalized 0-1 floats
-  chessboard_img_resized = np.asarray( \
-        PIL.Image.fromarray(chessboard_img) \
-        .resize([256,256], PIL.Image.BILINEAR), dtype=np.float32) / 255.0
-
-  # stack deep 64 tiles with 3 channesl RGB each
-  # so, first 3 slabs are RGB for tile A1, then next 3 slabs for tile A2 etc.
-  tiles = np.zeros([32,32,3*64], dtype=np.float32) # color
-  # Assume A1 is bottom left of image, need to reverse rank since images start
-  # with origin in top left
-  for rank in range(8): # rows (numbers)
-    for file in range(8): # columns (letters)
-      # color
-      tiles[:,:,3*(rank*8+file):3*(rank*8+file+1)] = \
-        chessboard_img_resized[(7-rank)*32:((7-rank)+1)*32,file*32:(file+1)*32]
-
-  return tiles
+  # 64 rows of RGB tiles, first row is tile A1, then B1 etc.
+  return getTiles(chessboard_img_resized, dtype)
 
-def getChessBoardGray(img, corners):
+def getChessBoardGray(img, corners, normalize=True):
   # img is a grayscale image
   # corners = (x0, y0, x1, y1) for top-left corner to bot-right corner of board
-  height, width = img.shape
-
-  # corners could be outside image bounds, pad image as needed
-  padl_x = max(0, -corners[0])
-  padl_y = max(0, -corners[1])
-  padr_x = max(0, corners[2] - width)
-  padr_y = max(0, corners[3] - height)
-
-  img_padded = np.pad(img, ((padl_y,padr_y),(padl_x,padr_x)), mode='edge')
-
-  chessboard_img = img_padded[
-    (padl_y + corners[1]):(padl_y + corners[3]), 
-    (padl_x + corners[0]):(padl_x + corners[2])]
+  # normalize: return 0-1 floats if True, otherwise the uint8 0-255 image
 
   # 256x256 px image, 32x32px individual tiles
-  # Normalized
-  chessboard_img_resized = np.asarray( \
-        PIL.Image.fromarray(chessboard_img) \
-        .resize([256,256], PIL.Image.BILINEAR), dtype=np.uint8) / 255.0
+  # corners could be outside image bounds, those pixels are clamped to the edge
+  chessboard_img_resized = toUint8(resampleChessboard(img, corners))
+  if normalize:
+    return np.multiply(chessboard_img_resized, 1.0 / 255.0, dtype=np.float32)
   return chessboard_img_resized
 
-def getChessTilesGray(img, corners):
-  chessboard_img_resized = getChessBoardGray(img, corners)
-  return getTiles(chessboard_img_resized)
+def getChessTilesGray(img, corners, dtype=np.float32):
+  chessboard_img_resized = getChessBoardGray(img, corners, normalize=False)
+  return getTiles(chessboard_img_resized, dtype)
 
 
-def getTiles(processed_gray_img):
-  # Given 256x256 px normalized grayscale image of a chessboard (32x32px per tile)
-  # NOTE (values must be in range 0-1)
-  # Return a 32x32x64 tile array
-  # 
-  # stack deep 64 tiles
-  # so, first slab is tile A1, then A2 etc.
-  tiles = np.zeros([32,32,64], dtype=np.float32) # grayscale
+def getTiles(processed_img, dtype=np.float32):
+  # Given 256x256 px grayscale (or 256x256x3 RGB) image of a chessboard with
+  # 32x32px per tile, either uint8 0-255 or normalized 0-1 floats
+  # Return a 64x1024 (64x3072 for RGB) tile array, which is the input layout
+  # of the CNN, one flattened tile per row in rank-order A1, B1, ..., H8
+  #
+  # dtype: float32 for normalized 0-1 tiles or uint8 for 0-255 tiles
+  #
   # Assume A1 is bottom left of image, need to reverse rank since images start
-  # with origin in top left
-  for rank in range(8): # rows (numbers)
-    for file in range(8): # columns (letters)
-      tiles[:,:,(rank*8+file)] = \
-        processed_gray_img[(7-rank)*32:((7-rank)+1)*32,file*32:(file+1)*32]
+  # with origin in top left. Splitting into [rank, y, file, x] and swapping the
+  # middle axes is only a view, the single copy is writing the output rows.
+  board_view = processed_img.reshape(8, 32, 8, -1)[::-1].swapaxes(1, 2)
+  tiles = np.empty([64, board_view[0,0].size], dtype=dtype)
+  tiles_view = tiles.reshape(board_view.shape)
+
+  from_uint8 = processed_img.dtype == np.uint8
+  to_uint8 = tiles.dtype == np.uint8
+  if from_uint8 and not to_uint8:
+    np.multiply(board_view, 1.0 / 255.0, out=tiles_view, dtype=tiles.dtype)
+  elif to_uint8 and not from_uint8:
+    tiles_view[...] = np.rint(board_view * 255.0)
+  else:
+    tiles_view[...] = board_view
+  return tiles
 
+# (dx, dy, scale) re-crops of a tile, shifts are fractions of a tile width
+# (0.06 is about 2px of a 32px tile) and scales are about the tile center
+TILE_JITTERS = ((-0.06, 0, 1), (0.06, 0, 1), (0, -0.06, 1), (0, 0.06, 1),
+                (0, 0, 0.94), (0, 0, 1.06))
+
+def getJitteredTiles(img_gray, corners, tile_indices, jitters=TILE_JITTERS,
+                     dtype=np.uint8):
+  """Return len(tile_indices) * len(jitters) x 1024 tiles re-cropped from the
+  grayscale image array at sub-pixel shifts and scales of their square
+  within corners, grouped by tile.
+
+  tile_indices are in the rank-order A1-H8 of getTiles. Each re-crop is the
+  tile's block of the whole board resampled with the tile moved, so with no
+  shift it matches getChessTilesGray, but only the requested tiles' pixels
+  are resampled and the cost is proportional to their number."""
+  x0, y0, x1, y1 = [float(c) for c in corners]
+  tile_w = (x1 - x0) / 8
+  tile_h = (y1 - y0) / 8
+  tiles = np.empty([len(tile_indices) * len(jitters), 32*32], dtype=dtype)
+  i = 0
+  for index in tile_indices:
+    # A1 is bottom left, image rows start at the top
+    col = index % 8
+    row = 7 - index // 8
+    for dx, dy, scale in jitters:
+      # Board with scaled tiles, placed so this tile is shifted by dx, dy
+      left = x0 + (col + 0.5 + dx - 0.5 * scale) * tile_w - col * scale * tile_w
+      top = y0 + (row + 0.5 + dy - 0.5 * scale) * tile_h - row * scale * tile_h
+      _, _, r0, r1, row_matrix = getResampleWeights(
+        top, top + 8 * scale * tile_h, img_gray.shape[0], block=row)
+      _, _, c0, c1, col_matrix = getResampleWeights(
+        left, left + 8 * scale * tile_w, img_gray.shape[1], block=col)
+      crop = img_gray[r0:r1, c0:c1].astype(np.float32)
+      tile = toUint8(row_matrix.dot(crop).dot(col_matrix.T))
+      if dtype == np.uint8:
+        tiles[i] = tile.ravel()
+      else:
+        tiles[i] = tile.ravel() * (1.0 / 255.0)
+      i += 1
   return tiles
 
-def findGrayscaleTilesInImage(img):
-  """ Find chessboard and convert into input tiles for CNN """
+def getBoardCrop(img_gray, corners, margin=1):
+  """Return (crop, corners) of the grayscale image array cut down to the board
+  within corners plus margin tiles on every side, with corners moved into the
+  crop. getJitteredTiles gives the same re-crops from these as from the whole
+  image, for a fraction of the pixels."""
+  x0, y0, x1, y1 = [float(c) for c in corners]
+  margin_x = margin * (x1 - x0) / 8
+  margin_y = margin * (y1 - y0) / 8
+  left = min(max(int(np.floor(x0 - margin_x)), 0), img_gray.shape[1])
+  top = min(max(int(np.floor(y0 - margin_y)), 0), img_gray.shape[0])
+  right = max(min(int(np.ceil(x1 + margin_x)), img_gray.shape[1]), left)
+  bottom = max(min(int(np.ceil(y1 + margin_y)), img_gray.shape[0]), top)
+  crop = np.ascontiguousarray(img_gray[top:bottom, left:right])
+  return crop, [x0 - left, y0 - top, x1 - left, y1 - top]
+
+def findGrayscaleTilesInImage(img, dtype=np.uint8, cache=None):
+  """ Find chessboard and convert into input tiles for CNN
+
+  dtype: uint8 0-255 tiles by default, 4x smaller than normalized float32
+  tiles, the ChessboardPredictor backends scale them at the model boundary
+  cache: optional caching.FinderCache, images with the same pixels as one seen
+  before reuse its corners, or its verdict of having no chessboard"""
   if img is None:
     return None, None
 
-  # Convert to grayscale numpy array 
-  img_arr = np.asarray(img.convert("L"), dtype=np.float32)
-  
-  # Use computer vision to find orthorectified chessboard corners in image
-  corners = findChessboardCorners(img_arr)
-  if corners is None:
-    return None, None
+  if cache is not None:
+    # Key on the decoded grayscale pixels
+    img_gray = np.asarray(img.convert("L"))
+    key = cache.getKey(img_gray)
+    hit, corners = cache.get(key)
+    if not hit:
+      corners = None
+      if precheckChessboard(img_gray):
+        corners = findChessboardCorners(img_gray.astype(np.float32),
+                                        precheck=False)
+      cache.put(key, corners)
+    if corners is None:
+      return None, None
+    img_arr = img_gray
+  else:
+    # Reject images with no chessboard before any full resolution work
+    if not precheckChessboard(img):
+      return None, None
+
+    # Convert to grayscale numpy array 
+    img_arr = np.asarray(img.convert("L"), dtype=np.float32)
+    
+    # Use computer vision to find orthorectified chessboard corners in image
+    corners = findChessboardCorners(img_arr, precheck=False)
+    if corners is None:
+      return None, None
 
   # Pull grayscale tiles out given image and chessboard corners
-  tiles = getChessTilesGray(img_arr, corners)
+  tiles = getChessTilesGray(img_arr, corners, dtype)
 
   # Return both the tiles as well as chessboard corner locations in the image
   return tiles, corners
 
+def loadImage(image):
+  """Return PIL image for an image filepath, url, PIL image or numpy array"""
+  if isinstance(image, PIL.Image.Image):
+    return image
+  if isinstance(image, np.ndarray):
+    return PIL.Image.fromarray(image)
+  if image.startswith('http://') or image.startswith('https://'):
+    img, _ = loadImageFromURL(image)
+    if img is None:
+      raise IOError('Couldn\'t load url: %s' % image)
+    return img
+  return loadImageFromPath(image)
+
+def _findCornersWorker(image):
+  """Return (corners, error) for one image, run inside pool workers"""
+  try:
+    img = loadImage(image)
+    if not precheckChessboard(img):
+      return None, None
+    img_arr = np.asarray(img.convert("L"), dtype=np.float32)
+    return findChessboardCorners(img_arr, precheck=False), None
+  except Exception as e:
+    return None, '%s: %s' % (type(e).__name__, e)
+
+def _findTilesWorker(image, dtype=np.uint8):
+  """Return (tiles, corners, error) for one image, run inside pool workers"""
+  try:
+    tiles, corners = findGrayscaleTilesInImage(loadImage(image), dtype)
+    return tiles, corners, None
+  except Exception as e:
+    return None, None, '%s: %s' % (type(e).__name__, e)
+
+def iterBatch(worker, images, processes=None, max_pending=None):
+  """Yield worker(image) for every image in input order, fanned out over a
+  pool of processes (all cores by default, 1 runs serially in-process).
+
+  images can be any iterable and is consumed lazily, at most max_pending
+  images (default 2 per process) are in flight at once to bound memory."""
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  if processes <= 1:
+    for image in images:
+      yield worker(image)
+    return
+
+  if max_pending is None:
+    max_pending = 2 * processes
+
+  pool = multiprocessing.Pool(processes)
+  try:
+    pending = deque()
+    for image in images:
+      pending.append(pool.apply_async(worker, (image,)))
+      if len(pending) >= max_pending:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+def iterChessboardCornersBatch(images, processes=None, max_pending=None):
+  """Yield (corners, error) for each image in order, see iterBatch"""
+  return iterBatch(_findCornersWorker, images, processes, max_pending)
+
+def findChessboardCornersBatch(images, processes=None, max_pending=None):
+  """Find chessboard corners in many images (filepaths, urls, PIL images or
+  numpy arrays) in parallel.
+
+  Returns list of (corners, error) in input order, corners is None if no
+  chessboard was found or the image failed, error is None or a message"""
+  return list(iterChessboardCornersBatch(images, processes, max_pending))
+
+def iterGrayscaleTilesInImageBatch(images, dtype=np.uint8, processes=None,
+                                   max_pending=None):
+  """Yield (tiles, corners, error) for each image in order, see iterBatch"""
+  worker = functools.partial(_findTilesWorker, dtype=dtype)
+  return iterBatch(worker, images, processes, max_pending)
+
+def findGrayscaleTilesInImageBatch(images, dtype=np.uint8, processes=None,
+                                   max_pending=None):
+  """Find chessboards and extract CNN input tiles for many images in parallel.
+
+  Returns list of (tiles, corners, error) in input order"""
+  return list(iterGrayscaleTilesInImageBatch(images, dtype, processes,
+                                             max_pending))
+
 # DEBUG
 # from matplotlib import pyplot as plt
 # def plotTiles(tiles):
@@ -359,58 +667,53 @@ def findGrayscaleTilesInImage(img):
 #     for file in range(8): # columns (letters)
 #       plt.subplot(8,8,(7-rank)*8 + file + 1) # Plot rank reverse order to match image
       
-#       if tiles.shape[2] == 64:
+#       if tiles.shape[1] == 32*32:
 #         # Grayscale
-#         tile = tiles[:,:,(rank*8+file)] # grayscale
+#         tile = tiles[rank*8+file].reshape(32,32) # grayscale
 #         plt.imshow(tile, interpolation='None', cmap='gray', vmin = 0, vmax = 1)
 #       else:
 #         #Color
-#         tile = tiles[:,:,3*(rank*8+file):3*(rank*8+file+1)] # color
+#         tile = tiles[rank*8+file].reshape(32,32,3) # color
 #         plt.imshow(tile, interpolation='None',)
       
 #       plt.axis('off')
 #       plt.title('%s %d' % (files[file], rank+1), fontsize=6)
 #   plt.show()
 
-def main(url):
-  print("Loading url %s..." % url)
-  color_img, url = loadImageFromURL(url)
-  
-  # Fail if can't load image
-  if color_img is None:
-    print('Couldn\'t load url: %s' % url)
-    return
-
-  if color_img.mode != 'RGB':
-    color_img = color_img.convert('RGB')
-  print("Processing...")
+def main(urls, processes=None):
+  # Resolve imgur links up front so the visualize links point at images
+  urls = [tryUpdateImgurURL(url) for url in urls]
+  print("Processing %d urls..." % len(urls))
   a = time()
-  img_arr = np.asarray(color_img.convert("L"), dtype=np.float32)
-  corners = findChessboardCorners(img_arr)
+  results = iterChessboardCornersBatch(urls, processes)
+  for url, (corners, error) in zip(urls, results):
+    # corners = [x0, y0, x1, y1] where (x0,y0) 
+    # is top left and (x1,y1) is bot right
+    if error is not None:
+      print('Couldn\'t process url %s: %s' % (url, error))
+    elif corners is not None:
+      print("\tFound corners for %s: %s" % (url, corners))
+      link = getVisualizeLink(corners, url)
+      print(link)
+
+      # color_img = loadImage(url).convert('RGB')
+      # tiles = getChessTilesColor(np.array(color_img), corners)
+      # plotTiles(tiles)
+
+      # plt.imshow(color_img, interpolation='none')
+      # plt.plot(corners[[0,0,2,2,0]]-0.5, corners[[1,3,3,1,1]]-0.5, color='red', linewidth=1)
+      # plt.show()
+    else:
+      print('\tNo corners found in image %s' % url)
   print("Took %.4fs" % (time()-a))
-  # corners = [x0, y0, x1, y1] where (x0,y0) 
-  # is top left and (x1,y1) is bot right
-
-  if corners is not None:
-    print("\tFound corners for %s: %s" % (url, corners))
-    link = getVisualizeLink(corners, url)
-    print(link)
-
-    # tiles = getChessTilesColor(np.array(color_img), corners)
-    # tiles = getChessTilesGray(img_arr, corners)
-    # plotTiles(tiles)
-
-    # plt.imshow(color_img, interpolation='none')
-    # plt.plot(corners[[0,0,2,2,0]]-0.5, corners[[1,3,3,1,1]]-0.5, color='red', linewidth=1)
-    # plt.show()
-  else:
-    print('\tNo corners found in image')
 
 if __name__ == '__main__':
   np.set_printoptions(suppress=True, precision=2)
   parser = argparse.ArgumentParser(description='Find orthorectified chessboard corners in image')
   parser.add_argument('urls', default=['https://i.redd.it/1uw3h772r0fy.png'],
     metavar='urls', type=str,  nargs='*', help='Input image urls')
+  parser.add_argument('--processes', type=int, default=None,
+    help='Number of worker processes (default all cores, 1 runs serially)')
   # main('http://www.chessanytime.com/img/jeudirect/simplechess.png')
   # main('https://i.imgur.com/JpzfV3y.jpg')
   # main('https://i.imgur.com/jsCKzU9.jpg')
@@ -421,6 +724,5 @@ if __name__ == '__main__':
   # main('https://i.imgur.com/Ns0iBrw.jpg')
   # main('https://i.imgur.com/KLcCiuk.jpg')
   args = parser.parse_args()
-  for url in args.urls:
-    main(url)
+  main(args.urls, args.processes)
 
@@ -12,16 +12,19 @@ import time
 from datetime import datetime
 import argparse
 
-import tensorflow_chessbot # For neural network model
+import prediction_server # Share a model loaded by a running prediction server
+import caching # Reuse corners found for reposted images
+import helper_image_loading # Remember resolved imgur links and images
 from helper_functions_chessbot import *
 from helper_functions import shortenFEN
 from cfb_helpers import * # logging, comment waiting and self-reply helpers
 
-def generateResponseMessage(submission, predictor):
+def generateResponseMessage(submission, predictor, finder_cache=None):
   print("\n---\nImage URL: %s" % submission.url)
   
   # Use CNN to make a prediction
-  fen, certainty, visualize_link = predictor.makePrediction(submission.url)
+  fen, certainty, visualize_link = predictor.makePrediction(submission.url,
+    finder_cache=finder_cache)
 
   if fen is None:
     print("> %s - Couldn't generate FEN, skipping..." % datetime.now())
@@ -40,12 +43,13 @@ def generateResponseMessage(submission, predictor):
   return msg
 
 
-def processSubmission(submission, cfb, predictor, args, reply_wait_time=10):
+def processSubmission(submission, cfb, predictor, args, reply_wait_time=10,
+                      finder_cache=None):
   # Check if submission passes requirements and wasn't already replied to
   if isPotentialChessboardTopic(submission):
     if not previouslyRepliedTo(submission, cfb):
       # Generate response
-      response = generateResponseMessage(submission, predictor)
+      response = generateResponseMessage(submission, predictor, finder_cache)
       if response is None:
         logMessage(submission,"[NO-FEN]") # Skip since couldn't generate FEN
         return
@@ -66,20 +70,39 @@ def processSubmission(submission, cfb, predictor, args, reply_wait_time=10):
     logMessage(submission)
     time.sleep(1) # Wait a second between normal submissions
 
+def setupPipeline(args):
+  """Return (predictor, finder cache, list of all caches) for the args, the
+  imgur url and image caches are set for helper_image_loading"""
+  predictor = prediction_server.connectPredictor(
+    args.server, tile_cache_path=args.tile_cache)
+  finder_cache = caching.FinderCache(cache_dir=args.cache_dir)
+  url_cache = caching.URLCache(cache_dir=args.url_cache_dir)
+  helper_image_loading.setImgurCache(url_cache)
+  image_cache = caching.ImageCache(args.image_cache_dir)
+  helper_image_loading.setImageCache(image_cache)
+  # A prediction server keeps its own tile cache, only list a local one
+  caches = [finder_cache, predictor.tile_cache, url_cache, image_cache]
+  return predictor, finder_cache, [cache for cache in caches if cache is not None]
+
+def printCacheStats(caches):
+  for cache in caches:
+    print(cache)
+
 def main(args):
   resetTensorflowGraph()
   running = True
   reddit = praw.Reddit('CFB') # client credentials set up in local praw.ini file
   cfb = reddit.user.me() # ChessFenBot object
   subreddit = reddit.subreddit('chess+chessbeginners+AnarchyChess+betterchess+chesspuzzles')
-  predictor = tensorflow_chessbot.ChessboardPredictor()
+  predictor, finder_cache, caches = setupPipeline(args)
 
   while running:
     # Start live stream on all submissions in the subreddit
     stream = subreddit.stream.submissions()
     try:
       for submission in stream:
-        processSubmission(submission, cfb, predictor, args)
+        processSubmission(submission, cfb, predictor, args,
+                          finder_cache=finder_cache)
     except (socket.error, requests.exceptions.ReadTimeout,
             requests.packages.urllib3.exceptions.ReadTimeoutError,
             requests.exceptions.ConnectionError) as e:
@@ -98,6 +121,7 @@ def main(args):
       break
 
   predictor.close()
+  printCacheStats(caches)
   print('Finished')
 
 def resetTensorflowGraph():
@@ -110,21 +134,23 @@ def runSpecificSubmission(args):
   resetTensorflowGraph()
   reddit = praw.Reddit('CFB') # client credentials set up in local praw.ini file
   cfb = reddit.user.me() # ChessFenBot object
-  predictor = tensorflow_chessbot.ChessboardPredictor()
+  predictor, finder_cache, caches = setupPipeline(args)
 
   submission = reddit.submission(args.sub)
   print("URL: ", submission.url)
   if submission:
     print('Processing...')
-    processSubmission(submission, cfb, predictor, args)
+    processSubmission(submission, cfb, predictor, args,
+                      finder_cache=finder_cache)
 
   predictor.close()
+  printCacheStats(caches)
   print('Done')
 
-def dryRunTest(submission='5tuerh'):
+def dryRunTest(args, submission='5tuerh'):
   resetTensorflowGraph()
   reddit = praw.Reddit('CFB') # client credentials set up in local praw.ini file
-  predictor = tensorflow_chessbot.ChessboardPredictor()
+  predictor, finder_cache, caches = setupPipeline(args)
 
   # Use a specific submission
   submission = reddit.submission(submission)
@@ -132,7 +158,7 @@ def dryRunTest(submission='5tuerh'):
   # Check if submission passes requirements and wasn't already replied to
   if isPotentialChessboardTopic(submission):
     # Generate response
-    response = generateResponseMessage(submission, predictor)
+    response = generateResponseMessage(submission, predictor, finder_cache)
     print("RESPONSE:\n")
     print('-----------------------------')
     print(response)
@@ -141,6 +167,7 @@ def dryRunTest(submission='5tuerh'):
     print('Submission not considered chessboard topic')
 
   predictor.close()
+  printCacheStats(caches)
   print('Finished')
 
   
@@ -152,13 +179,23 @@ if __name__ == '__main__':
   parser.add_argument('--test', help='Dry run test on pre-existing comment)',
                       action="store_true", default=False)
   parser.add_argument('--sub', help='Pass submission string to process')
+  parser.add_argument('--cache_dir', default='finder_cache',
+                      help='Folder to cache found chessboard corners in')
+  parser.add_argument('--tile_cache', default='tile_cache.bin',
+                      help='File to cache tile classifications in, shared with other processes')
+  parser.add_argument('--url_cache_dir', default='url_cache',
+                      help='Folder to cache imgur page image urls in')
+  parser.add_argument('--image_cache_dir', default='image_cache',
+                      help='Folder to cache downloaded images in')
+  parser.add_argument('--server', default=prediction_server.DEFAULT_SERVER_ADDRESS,
+                      help='Prediction server to use if running, else the model is loaded locally')
   args = parser.parse_args()
   if args.test:
     print('Doing dry run test on submission')
     if args.sub:
-      dryRunTest(args.sub)
+      dryRunTest(args, args.sub)
     else:
-      dryRunTest()
+      dryRunTest(args)
   elif args.sub is not None:
     runSpecificSubmission(args)
   else:
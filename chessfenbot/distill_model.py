@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# usage: distill_model.py [-h] [--tile_folder TILE_FOLDER]
+#                         [--image_folder IMAGE_FOLDER]
+#                         [--teacher_backend {numpy,tf,tflite}]
+#                         [--teacher_path TEACHER_PATH] [--npz NPZ]
+#                         [--conv_widths CONV_WIDTHS] [--steps STEPS]
+#                         [--batch_size BATCH_SIZE] [--temperature TEMPERATURE]
+#                         [--learning_rate LEARNING_RATE]
+#                         [--num_eval NUM_EVAL] [--min_agreement MIN_AGREEMENT]
+#
+# Distill the piece classifier CNN into a compact student network
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   --tile_folder TILE_FOLDER
+#                         Folder of 32x32 tile pngs, searched recursively (ex.
+#                         the output of tileset_generator.py), tiles named
+#                         <FEN>_<file><rank>.png also get accuracy reported
+#   --image_folder IMAGE_FOLDER
+#                         Folder of chessboard screenshots to extract tiles
+#                         from
+#   --teacher_backend {numpy,tf,tflite}
+#                         runtime of the teacher model (default tf)
+#   --teacher_path TEACHER_PATH
+#                         teacher model file (default
+#                         saved_models/frozen_graph.pb for tf)
+#   --npz NPZ             Output student weights path for the numpy backend
+#                         (default saved_models/cf_compact.npz)
+#   --conv_widths CONV_WIDTHS
+#                         Comma separated channels of the student's 3x3 convs
+#                         (default 16,32,32)
+#   --steps STEPS         Training steps (default 3000)
+#   --batch_size BATCH_SIZE
+#                         Tiles per training step (default 128)
+#   --temperature TEMPERATURE
+#                         Softening of the teacher probabilities (default 2)
+#   --learning_rate LEARNING_RATE
+#                         Adam learning rate (default 0.003)
+#   --num_eval NUM_EVAL   Tiles held out of training for the report (default
+#                         1024)
+#   --min_agreement MIN_AGREEMENT
+#                         Smallest fraction of held out tiles the student must
+#                         label the same as the teacher to be written
+#                         (default 0.99)
+#
+# The existing network spends most of its weights and multiply-adds on the
+# 4096x1024 dense layer. The student is a few narrow 3x3 convs with a global
+# average pool and a single small dense readout (see numpy_model), about 10x
+# fewer multiply-adds and 300x fewer weights, trained to match the teacher's
+# temperature softened probabilities on local tiles. Tiles need no labels, the
+# teacher provides them, and training tiles are randomly shifted by up to 2px
+# and have their brightness and contrast varied.
+#
+# The student is saved as a .npz for the numpy backend of ChessboardPredictor:
+#   ChessboardPredictor(backend='numpy', model_path='saved_models/cf_compact.npz')
+# and only written if it agrees with the teacher on at least --min_agreement
+# of the held out tiles. A report compares size, speed and agreement (and
+# accuracy on labeled tiles) of both models.
+import argparse
+import glob
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' # Ignore Tensorflow INFO debug messages
+from time import time
+
+import numpy as np
+import PIL.Image
+
+import chessboard_finder
+import helper_functions
+import numpy_model
+import predictor_backends
+import quantize_model
+
+def loadTileFolder(tile_folder):
+  """Return (Nx1024 uint8 rows, N label indices or -1 if unlabeled) of every
+  32x32 png under tile_folder"""
+  paths = sorted(glob.glob(os.path.join(tile_folder, '**', '*.png'),
+                           recursive=True))
+  rows = []
+  labels = []
+  for path in paths:
+    img = PIL.Image.open(path)
+    if img.size != (32, 32):
+      continue
+    rows.append(np.asarray(img.convert("L"), dtype=np.uint8).reshape(32*32))
+    # Tile filenames of the training set are the 71 character FEN, an
+    # underscore and the square
+    name = os.path.basename(path)
+    if len(name) == 78 and name[-7] == '_':
+      labels.append(helper_functions.getFENtileLabel(
+        name[:71], name[-6], int(name[-5])).argmax())
+    else:
+      labels.append(-1)
+  if not rows:
+    return np.empty([0, 32*32], dtype=np.uint8), np.empty(0, dtype=int)
+  return np.array(rows), np.array(labels)
+
+def loadImageFolder(image_folder, processes=None):
+  """Return Nx1024 uint8 rows of the tiles of every chessboard found in the
+  png/jpg/gif screenshots in image_folder"""
+  paths = sorted(path for ext in ('png', 'jpg', 'gif')
+                 for path in glob.glob(os.path.join(image_folder, '*.' + ext)))
+  boards = [tiles for tiles, corners, error in
+            chessboard_finder.iterGrayscaleTilesInImageBatch(
+              paths, processes=processes) if tiles is not None]
+  print("Found chessboards in %d/%d images" % (len(boards), len(paths)))
+  if not boards:
+    return np.empty([0, 32*32], dtype=np.uint8)
+  return np.concatenate(boards)
+
+def augmentTiles(rows, rng, max_shift=2):
+  """Return copy of uint8 rows randomly shifted by up to max_shift px (edges
+  repeated) with brightness and contrast varied"""
+  tiles = rows.reshape(-1, 32, 32)
+  padded = np.pad(tiles, ((0, 0), (max_shift, max_shift), (max_shift, max_shift)),
+                  mode='edge')
+  shifted = np.empty_like(tiles)
+  offsets = rng.randint(0, 2 * max_shift + 1, size=[len(tiles), 2])
+  for i, (dy, dx) in enumerate(offsets):
+    shifted[i] = padded[i, dy:dy+32, dx:dx+32]
+  contrast = rng.uniform(0.8, 1.2, size=[len(tiles), 1, 1])
+  brightness = rng.uniform(-20, 20, size=[len(tiles), 1, 1])
+  shifted = (shifted - 128.0) * contrast + 128.0 + brightness
+  return chessboard_finder.toUint8(shifted).reshape(-1, 32*32)
+
+def softenProbabilities(probabilities, temperature):
+  """Return probabilities as if their logits were divided by temperature"""
+  logits = np.log(np.maximum(probabilities, 1e-12)) / temperature
+  return numpy_model.softmax(logits)
+
+def buildStudentGraph(conv_widths, temperature, learning_rate):
+  """Return (graph, input, soft targets, train op, init op, loss, weight
+  variables) of the compact student, weights named like numpy_model's
+  compact network"""
+  import tensorflow as tf
+  graph = tf.Graph()
+  weights = {}
+  with graph.as_default():
+    x = tf.placeholder(tf.uint8, [None, 32*32], 'Input')
+    targets = tf.placeholder(tf.float32, [None, 13], 'Targets')
+    h = tf.reshape(tf.cast(x, tf.float32) * (1.0 / 255.0), [-1, 32, 32, 1])
+
+    channels = 1
+    for i, width in enumerate(conv_widths, 1):
+      W = tf.Variable(tf.truncated_normal([3, 3, channels, width],
+        stddev=np.sqrt(2.0 / (9 * channels))), name='W%d' % i)
+      b = tf.Variable(tf.zeros([width]), name='B%d' % i)
+      h = tf.nn.relu(tf.nn.bias_add(
+        tf.nn.conv2d(h, W, strides=[1, 1, 1, 1], padding='SAME'), b))
+      if i < len(conv_widths):
+        h = tf.nn.max_pool(h, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1],
+                           padding='SAME')
+      weights['W%d' % i], weights['B%d' % i] = W, b
+      channels = width
+
+    i = len(conv_widths) + 1
+    W = tf.Variable(tf.truncated_normal([channels, 13],
+      stddev=np.sqrt(1.0 / channels)), name='W%d' % i)
+    b = tf.Variable(tf.zeros([13]), name='B%d' % i)
+    weights['W%d' % i], weights['B%d' % i] = W, b
+    logits = tf.nn.bias_add(tf.matmul(tf.reduce_mean(h, axis=[1, 2]), W), b)
+
+    # Cross entropy with the softened teacher, scaled by temperature^2 to
+    # keep gradient sizes independent of the temperature
+    loss = temperature**2 * tf.reduce_mean(-tf.reduce_sum(
+      targets * tf.nn.log_softmax(logits / temperature), axis=1))
+    train_op = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+    init_op = tf.global_variables_initializer()
+  return graph, x, targets, train_op, init_op, loss, weights
+
+def trainStudent(rows, teacher_probabilities, conv_widths=(16, 32, 32),
+                 steps=3000, batch_size=128, temperature=2.0,
+                 learning_rate=0.003, seed=0):
+  """Return compact student weights dict trained to match the teacher
+  probabilities on augmented uint8 rows"""
+  import tensorflow as tf
+  rng = np.random.RandomState(seed)
+  soft_targets = softenProbabilities(teacher_probabilities, temperature)
+  graph, x, targets, train_op, init_op, loss, weights = buildStudentGraph(
+    conv_widths, temperature, learning_rate)
+  with tf.Session(graph=graph) as sess:
+    sess.run(init_op)
+    a = time()
+    for step in range(1, steps + 1):
+      batch = rng.randint(0, len(rows), batch_size)
+      _, batch_loss = sess.run([train_op, loss], feed_dict={
+        x: augmentTiles(rows[batch], rng), targets: soft_targets[batch]})
+      if step % 500 == 0 or step == steps:
+        print("Step %d/%d: loss %.4f (%.1fs)" % (step, steps, batch_loss,
+                                                 time() - a))
+    values = sess.run(weights)
+  values['architecture'] = np.array('compact')
+  return values
+
+def countParameters(weights):
+  return sum(value.size for name, value in weights.items()
+             if name != 'architecture' and not name.endswith('_scale'))
+
+def runAll(model, rows, batch_size=1024):
+  """Return (Nx13 probabilities, seconds per tile) of a backend on rows"""
+  probabilities = np.empty([len(rows), 13], dtype=np.float32)
+  a = time()
+  for start in range(0, len(rows), batch_size):
+    probabilities[start:start+batch_size] = model.run(rows[start:start+batch_size])
+  return probabilities, (time() - a) / len(rows)
+
+def printReport(name, model_path, num_parameters, probabilities,
+                seconds_per_tile, teacher_labels, labels):
+  """Print one line comparing a model on the held out tiles"""
+  agreement = (probabilities.argmax(axis=1) == teacher_labels).mean()
+  labeled = labels >= 0
+  accuracy = ', accuracy %.4f on %d labeled tiles' % (
+    (probabilities[labeled].argmax(axis=1) == labels[labeled]).mean(),
+    labeled.sum()) if labeled.any() else ''
+  print("%-8s %9d weights, %9d bytes, %.3f ms/tile, teacher agreement %.4f%s" % (
+    name, num_parameters, os.path.getsize(model_path) if os.path.isfile(model_path) else 0,
+    1000 * seconds_per_tile, agreement, accuracy))
+  return agreement
+
+def main(args):
+  if not args.tile_folder and not args.image_folder:
+    raise Exception('Need a --tile_folder or --image_folder of training tiles')
+  rows = [np.empty([0, 32*32], dtype=np.uint8)]
+  labels = [np.empty(0, dtype=int)]
+  if args.tile_folder:
+    tile_rows, tile_labels = loadTileFolder(args.tile_folder)
+    rows.append(tile_rows)
+    labels.append(tile_labels)
+  if args.image_folder:
+    image_rows = loadImageFolder(args.image_folder)
+    rows.append(image_rows)
+    labels.append(-np.ones(len(image_rows), dtype=int))
+  rows = np.concatenate(rows)
+  labels = np.concatenate(labels)
+
+  # Hold out a shuffled set of tiles for the report
+  order = np.random.RandomState(0).permutation(len(rows))
+  rows, labels = rows[order], labels[order]
+  num_eval = min(args.num_eval, len(rows) // 4)
+  if not num_eval:
+    raise Exception('Need at least 4 tiles, got %d' % len(rows))
+  eval_rows, eval_labels = rows[:num_eval], labels[:num_eval]
+  train_rows = rows[num_eval:]
+  print("%d training tiles, %d evaluation tiles" % (len(train_rows), num_eval))
+
+  teacher_path = args.teacher_path or \
+                 predictor_backends.DEFAULT_MODEL_PATHS[args.teacher_backend]
+  teacher = predictor_backends.loadBackend(args.teacher_backend, teacher_path)
+  teacher_probabilities, _ = runAll(teacher, train_rows)
+
+  conv_widths = [int(width) for width in args.conv_widths.split(',')]
+  weights = trainStudent(train_rows, teacher_probabilities, conv_widths,
+                         args.steps, args.batch_size, args.temperature,
+                         args.learning_rate)
+
+  # np.savez appends .npz to paths without it
+  tmp_path = args.npz + '.tmp.npz'
+  numpy_model.saveNpzWeights(weights, tmp_path)
+  student = predictor_backends.loadBackend('numpy', tmp_path)
+
+  print("\nHeld out tiles: %d" % num_eval)
+  teacher_eval, teacher_seconds = runAll(teacher, eval_rows)
+  teacher_labels = teacher_eval.argmax(axis=1)
+  # Weights can't be read back out of a TFLite flatbuffer
+  teacher_parameters = 0 if args.teacher_backend == 'tflite' else \
+    countParameters(quantize_model.loadFloatWeights(teacher_path))
+  printReport('teacher', teacher_path, teacher_parameters, teacher_eval,
+              teacher_seconds, teacher_labels, eval_labels)
+  student_eval, student_seconds = runAll(student, eval_rows)
+  agreement = printReport('student', tmp_path, countParameters(weights),
+                          student_eval, student_seconds, teacher_labels,
+                          eval_labels)
+  teacher.close()
+  student.close()
+
+  if agreement < args.min_agreement:
+    os.remove(tmp_path)
+    raise Exception('Student agrees with teacher on %.4f of tiles, less than '
+                    '%.4f, not writing %s' % (agreement, args.min_agreement,
+                                              args.npz))
+  os.rename(tmp_path, args.npz)
+  print("Wrote student model to %s" % args.npz)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Distill the piece classifier CNN into a compact student network')
+  parser.add_argument('--tile_folder', help='Folder of 32x32 tile pngs, searched recursively (ex. the output of tileset_generator.py), tiles named <FEN>_<file><rank>.png also get accuracy reported')
+  parser.add_argument('--image_folder', help='Folder of chessboard screenshots to extract tiles from')
+  parser.add_argument('--teacher_backend', default='tf', choices=sorted(predictor_backends.BACKENDS), help='runtime of the teacher model (default tf)')
+  parser.add_argument('--teacher_path', help='teacher model file (default saved_models/frozen_graph.pb for tf)')
+  parser.add_argument('--npz', default='saved_models/cf_compact.npz', help='Output student weights path for the numpy backend (default saved_models/cf_compact.npz)')
+  parser.add_argument('--conv_widths', default='16,32,32', help='Comma separated channels of the student\'s 3x3 convs (default 16,32,32)')
+  parser.add_argument('--steps', type=int, default=3000, help='Training steps (default 3000)')
+  parser.add_argument('--batch_size', type=int, default=128, help='Tiles per training step (default 128)')
+  parser.add_argument('--temperature', type=float, default=2.0, help='Softening of the teacher probabilities (default 2)')
+  parser.add_argument('--learning_rate', type=float, default=0.003, help='Adam learning rate (default 0.003)')
+  parser.add_argument('--num_eval', type=int, default=1024, help='Tiles held out of training for the report (default 1024)')
+  parser.add_argument('--min_agreement', type=float, default=0.99, help='Smallest fraction of held out tiles the student must label the same as the teacher to be written (default 0.99)')
+  args = parser.parse_args()
+  main(args)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# usage: export_model.py [-h] [--frozen_graph_path FROZEN_GRAPH_PATH]
+#                        [--optimized_graph OPTIMIZED_GRAPH]
+#                        [--tflite TFLITE] [--npz NPZ]
+#
+# Export the frozen graph CNN to other runtime model formats
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   --frozen_graph_path FROZEN_GRAPH_PATH
+#                         Frozen graph to export (default
+#                         saved_models/frozen_graph.pb)
+#   --optimized_graph OPTIMIZED_GRAPH
+#                         Output inference-only frozen graph path (ex.
+#                         saved_models/frozen_graph_optimized.pb)
+#   --tflite TFLITE       Output TFLite model path (ex.
+#                         saved_models/cf_v1.0.tflite)
+#   --npz NPZ             Output NumPy backend weights path (ex.
+#                         saved_models/cf_v1.0.npz)
+#
+# The weights are read out of the frozen graph. For the optimized frozen graph
+# and TFLite the inference part of the network from save_graph.py is rebuilt
+# around them, without the dropout and training ops, so the optimized graph
+# needs no KeepProb feed and runs fewer ops per session call. For the NumPy backend
+# the weights are saved as-is. After exporting, each new model is checked for
+# parity against the frozen graph on the example image tiles and random
+# tiles, and the export fails if the outputs differ.
+import argparse
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' # Ignore Tensorflow INFO debug messages
+import tensorflow as tf
+import numpy as np
+
+import chessboard_finder
+import helper_image_loading
+import numpy_model
+import predictor_backends
+from numpy_model import WEIGHT_NAMES
+
+def loadFrozenGraphWeights(frozen_graph_path):
+  """Return dict of CNN weight name (W1, B1, ... B5) to numpy array"""
+  with tf.gfile.GFile(frozen_graph_path, "rb") as f:
+    graph_def = tf.GraphDef()
+    graph_def.ParseFromString(f.read())
+
+  weights = {}
+  for node in graph_def.node:
+    if node.op == 'Const' and node.name in WEIGHT_NAMES:
+      weights[WEIGHT_NAMES[node.name]] = tf.make_ndarray(node.attr['value'].tensor)
+  missing = set(WEIGHT_NAMES.values()) - set(weights)
+  if missing:
+    raise Exception('Frozen graph %s is missing weights %s' % (
+      frozen_graph_path, ', '.join(sorted(missing))))
+  return weights
+
+def buildInferenceGraph(weights, batch_size=None, uint8_input=True):
+  """Return (graph, input, probabilities) for the inference-only CNN.
+
+  Same layers as save_graph.py with the weights as constants, and no dropout
+  or training ops. Biases use bias_add so TensorFlow can fuse them with the
+  preceding conv/matmul and following ReLU.
+
+  With uint8_input the Input is uint8 0-255 tiles, cast in the graph, and
+  the 1/255 normalization is folded into the first conv weights."""
+  graph = tf.Graph()
+  W1 = weights['W1']
+  with graph.as_default():
+    if uint8_input:
+      x = tf.placeholder(tf.uint8, [batch_size, 32*32], 'Input')
+      x_image = tf.reshape(tf.cast(x, tf.float32), [-1,32,32,1])
+      W1 = W1 * np.float32(1.0 / 255.0)
+    else:
+      x = tf.placeholder(tf.float32, [batch_size, 32*32], 'Input')
+      x_image = tf.reshape(x, [-1,32,32,1])
+
+    def conv_pool(h, W, b, name):
+      h = tf.nn.conv2d(h, tf.constant(W), strides=[1, 1, 1, 1], padding='SAME')
+      h = tf.nn.relu(tf.nn.bias_add(h, tf.constant(b)), name='Conv%s' % name)
+      return tf.nn.max_pool(h, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1],
+                            padding='SAME', name='Pool%s' % name)
+
+    h_pool1 = conv_pool(x_image, W1, weights['B1'], '1')
+    h_pool2 = conv_pool(h_pool1, weights['W2'], weights['B2'], '2')
+
+    h_pool2_flat = tf.reshape(h_pool2, [-1, 8*8*64], name='Pool3')
+    h_fc1 = tf.nn.relu(tf.nn.bias_add(
+      tf.matmul(h_pool2_flat, tf.constant(weights['W3'])),
+      tf.constant(weights['B3'])), 'MatMult3')
+
+    logits = tf.nn.bias_add(tf.matmul(h_fc1, tf.constant(weights['W5'])),
+                            tf.constant(weights['B5']))
+    probabilities = tf.nn.softmax(logits, name='probabilities')
+    tf.argmax(probabilities, 1, name='prediction')
+  return graph, x, probabilities
+
+def exportTFLite(weights, output_path, batch_size=64, representative_rows=None):
+  """Convert the inference CNN to a TFLite model, input is batch_size rows.
+
+  Input is uint8 tiles. If representative_rows (uint8) are given the model
+  is INT8 quantized, with activation ranges calibrated on them, output stays
+  float32."""
+  graph, x, probabilities = buildInferenceGraph(weights, batch_size)
+  with tf.Session(graph=graph) as sess:
+    try:
+      converter = tf.lite.TFLiteConverter.from_session(sess, [x], [probabilities])
+    except AttributeError:
+      # TensorFlow < 1.13
+      converter = tf.contrib.lite.TocoConverter.from_session(
+        sess, [x], [probabilities])
+    if representative_rows is not None:
+      if len(representative_rows) < batch_size:
+        raise Exception('Need at least %d representative rows, got %d' % (
+          batch_size, len(representative_rows)))
+      # Needs TensorFlow >= 1.14
+      converter.optimizations = [tf.lite.Optimize.DEFAULT]
+      converter.representative_dataset = lambda: (
+        [representative_rows[i:i+batch_size]] for i in
+          range(0, len(representative_rows) - batch_size + 1, batch_size))
+    tflite_model = converter.convert()
+
+  with open(output_path, 'wb') as f:
+    f.write(tflite_model)
+  print("Wrote %d byte TFLite model to %s" % (len(tflite_model), output_path))
+
+def optimizeGraphDef(graph_def, output_names=('probabilities', 'prediction')):
+  """Return graph_def reduced to the ops needed for output_names, with
+  training nodes removed and constants folded when graph_transforms exists"""
+  output_names = list(output_names)
+  graph_def = tf.graph_util.extract_sub_graph(graph_def, output_names)
+  graph_def = tf.graph_util.remove_training_nodes(graph_def, output_names)
+  try:
+    from tensorflow.tools.graph_transforms import TransformGraph
+  except ImportError:
+    # Not shipped with TensorFlow 2, the inference graph is already built from
+    # constants so only shape computations are left unfolded
+    return graph_def
+  return TransformGraph(graph_def, ['Input'], output_names, [
+    'strip_unused_nodes(type=uint8, shape="-1,1024")',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'sort_by_execution_order'])
+
+def exportFrozenGraph(weights, output_path):
+  """Write an inference-only frozen graph, same Input and probabilities
+  tensor names as save_graph.py but no KeepProb input, dropout or training
+  subgraphs, and Input takes uint8 tiles"""
+  graph, _, _ = buildInferenceGraph(weights)
+  graph_def = optimizeGraphDef(graph.as_graph_def())
+  with tf.gfile.GFile(output_path, "wb") as f:
+    f.write(graph_def.SerializeToString())
+  print("Wrote %d op frozen graph to %s" % (len(graph_def.node), output_path))
+
+def countGraphOps(frozen_graph_path):
+  with tf.gfile.GFile(frozen_graph_path, "rb") as f:
+    graph_def = tf.GraphDef()
+    graph_def.ParseFromString(f.read())
+  return len(graph_def.node)
+
+def getParityTiles(filepath='example_input.png', num_random=64):
+  """Return uint8 rows of example image tiles plus random tiles to compare
+  models on"""
+  boards = [np.random.RandomState(0).randint(0, 256, [num_random, 32*32]).astype(np.uint8)]
+  if os.path.exists(filepath):
+    img = helper_image_loading.loadImageFromPath(filepath)
+    tiles, _ = chessboard_finder.findGrayscaleTilesInImage(img)
+    if tiles is not None:
+      boards.insert(0, tiles)
+  return np.concatenate(boards)
+
+def checkParity(frozen_graph_path, backend, model_path, tolerance=1e-3):
+  """Compare a backend's outputs with the frozen graph on the same tiles,
+  raise if any probability differs by more than tolerance or labels differ"""
+  rows = getParityTiles()
+  reference = predictor_backends.loadBackend('tf', frozen_graph_path)
+  expected = reference.run(rows)
+  reference.close()
+
+  candidate = predictor_backends.loadBackend(backend, model_path)
+  actual = candidate.run(rows)
+  candidate.close()
+
+  max_diff = np.abs(actual - expected).max()
+  num_label_diffs = (actual.argmax(axis=1) != expected.argmax(axis=1)).sum()
+  print("Parity %s vs tf on %d tiles: max probability diff %g, %d label diffs" % (
+    backend, len(rows), max_diff, num_label_diffs))
+  if max_diff > tolerance or num_label_diffs > 0:
+    raise Exception('%s model %s does not match frozen graph %s' % (
+      backend, model_path, frozen_graph_path))
+
+def main(args):
+  weights = loadFrozenGraphWeights(args.frozen_graph_path)
+  if args.optimized_graph:
+    print("Frozen graph %s has %d ops" % (
+      args.frozen_graph_path, countGraphOps(args.frozen_graph_path)))
+    exportFrozenGraph(weights, args.optimized_graph)
+    checkParity(args.frozen_graph_path, 'tf', args.optimized_graph)
+  if args.tflite:
+    exportTFLite(weights, args.tflite)
+    checkParity(args.frozen_graph_path, 'tflite', args.tflite)
+  if args.npz:
+    numpy_model.saveNpzWeights(weights, args.npz)
+    print("Wrote NumPy model weights to %s" % args.npz)
+    checkParity(args.frozen_graph_path, 'numpy', args.npz)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Export the frozen graph CNN to other runtime model formats')
+  parser.add_argument('--frozen_graph_path', default='saved_models/frozen_graph.pb',
+                      help='Frozen graph to export (default saved_models/frozen_graph.pb)')
+  parser.add_argument('--optimized_graph', help='Output inference-only frozen graph path (ex. saved_models/frozen_graph_optimized.pb)')
+  parser.add_argument('--tflite', help='Output TFLite model path (ex. saved_models/cf_v1.0.tflite)')
+  parser.add_argument('--npz', help='Output NumPy backend weights path (ex. saved_models/cf_v1.0.npz)')
+  args = parser.parse_args()
+  main(args)
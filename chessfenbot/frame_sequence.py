@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# Predict the positions shown by an animated GIF, or a sequence of images, of
+# one chessboard, like a game replay
+#
+# Corners are found once, on the first frame with a chessboard, and reused for
+# every later frame. The board area of each frame is hashed, frames showing
+# the same board as the frame before (most of a replay, which holds each
+# position for many frames) or as any earlier frame are skipped, and only the
+# boards that changed are cut into tiles and classified, many boards per
+# inference batch. Consecutive positions with the same FEN are merged, and
+# the move between each pair of positions is inferred when they differ by
+# exactly one move.
+import numpy as np
+import PIL.ImageSequence
+
+import caching
+import chessboard_finder
+from helper_functions import lengthenFEN
+
+FILES = 'abcdefgh'
+
+def iterFrames(images):
+  """Yield a grayscale uint8 array for every frame of images, each a
+  filepath, url or PIL image, animated images yield all their frames"""
+  for image in images:
+    img = chessboard_finder.loadImage(image)
+    for frame in PIL.ImageSequence.Iterator(img):
+      yield np.asarray(frame.convert("L"))
+
+def getBoardKey(img_gray, corners):
+  """Return hash of the pixels within corners of a grayscale frame, so
+  changes outside the board (clocks, move lists) don't count"""
+  x0, y0, x1, y1 = [int(c) for c in corners]
+  return caching.hashArray(img_gray[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)])
+
+def getSquares(fen):
+  """Return dict of square name (ex. 'e4') to FEN piece letter, '1' for
+  empty, for the board part of a FEN, a1 is bottom left like the FEN"""
+  ranks = lengthenFEN(fen.split(' ')[0]).split('/')
+  return dict(('%s%d' % (FILES[col], 8 - row), piece)
+              for row, rank in enumerate(ranks) for col, piece in enumerate(rank))
+
+def isWhite(piece):
+  return piece.isupper()
+
+def inferMove(fen_before, fen_after):
+  """Return the move from board fen_before to fen_after in coordinate
+  notation (ex. e2e4, e1g1 for castling, e7e8q for a promotion), or None if
+  the boards don't differ by exactly one move (skipped frames, or a
+  misclassified tile)"""
+  before = getSquares(fen_before)
+  after = getSquares(fen_after)
+  changed = [square for square in sorted(before) if before[square] != after[square]]
+  emptied = [square for square in changed if after[square] == '1']
+  filled = [square for square in changed if after[square] != '1']
+
+  if len(emptied) == 2 and len(filled) == 2:
+    # Castling, a king and a rook of the same color both moved
+    kings = [(a, b) for a in emptied for b in filled
+             if before[a] in 'Kk' and after[b] == before[a]]
+    rooks = [(a, b) for a in emptied for b in filled
+             if before[a] in 'Rr' and after[b] == before[a]]
+    if len(kings) == 1 and len(rooks) == 1 and \
+       isWhite(before[kings[0][0]]) == isWhite(before[rooks[0][0]]) and \
+       all(before[square] == '1' for square in filled):
+      return ''.join(kings[0])
+    return None
+
+  if len(filled) != 1:
+    return None
+  to_square = filled[0]
+  piece = after[to_square]
+  captured = before[to_square]
+  if captured != '1' and isWhite(captured) == isWhite(piece):
+    return None
+
+  if len(emptied) == 1:
+    from_square = emptied[0]
+    moved = before[from_square]
+    if moved == piece:
+      return from_square + to_square
+    # Promotion, a pawn reaching the last rank becomes another piece
+    last_rank = '8' if isWhite(moved) else '1'
+    if moved in 'Pp' and piece not in 'PpKk' and \
+       isWhite(moved) == isWhite(piece) and to_square[1] == last_rank:
+      return from_square + to_square + piece.lower()
+    return None
+
+  if len(emptied) == 2 and piece in 'Pp' and captured == '1':
+    # En passant, the captured pawn is beside the pawn's starting square
+    origins = [square for square in emptied if before[square] == piece]
+    others = [square for square in emptied if square not in origins]
+    if len(origins) == 1 and len(others) == 1 and \
+       before[others[0]] == piece.swapcase() and \
+       others[0] == to_square[0] + origins[0][1]:
+      return origins[0] + to_square
+  return None
+
+def predictFrameSequence(predictor, images, batch_boards=16,
+                         refine_certainty=0, stats=None):
+  """Return list of the distinct positions in the frames of images, in order.
+
+  images is a list of filepaths, urls or PIL images, each one frame or an
+  animated GIF. Each position is a dict with the index of the first frame
+  showing it, the short FEN, its certainty and the move from the previous
+  position (None for the first, or if it can't be inferred). Boards below
+  refine_certainty are refined with ChessboardPredictor.refinePrediction.
+  stats: optional dict, filled with counts of frames, skipped frames and
+  classified boards"""
+  corners = None
+  frame_keys = [] # Board key of each frame, None before a board is found
+  predictions = {} # Board key to BoardPrediction
+  pending = [] # (key, frame, tiles) of new boards waiting to be classified
+  seen_keys = set()
+  previous_key = None
+  num_unchanged = 0
+  num_repeats = 0
+
+  def classify():
+    boards = predictor.getPredictions([tiles for _, _, tiles in pending])
+    for (key, frame, _), prediction in zip(pending, boards):
+      if prediction.certainty < refine_certainty:
+        prediction = predictor.refinePrediction(prediction, frame, corners,
+                                                refine_certainty)
+      predictions[key] = prediction
+    del pending[:]
+
+  for frame in iterFrames(images):
+    if corners is None:
+      if chessboard_finder.precheckChessboard(frame):
+        corners = chessboard_finder.findChessboardCorners(
+          frame.astype(np.float32), precheck=False)
+      if corners is None:
+        frame_keys.append(None)
+        continue
+
+    key = getBoardKey(frame, corners)
+    frame_keys.append(key)
+    if key == previous_key:
+      num_unchanged += 1
+      continue
+    previous_key = key
+    if key in seen_keys:
+      num_repeats += 1
+      continue
+    seen_keys.add(key)
+
+    pending.append((key, frame,
+                    chessboard_finder.getChessTilesGray(frame, corners, np.uint8)))
+    if len(pending) >= batch_boards:
+      classify()
+  if pending:
+    classify()
+
+  positions = []
+  for index, key in enumerate(frame_keys):
+    if key is None:
+      continue
+    prediction = predictions[key]
+    if positions and positions[-1]['fen'] == prediction.short_fen:
+      continue
+    positions.append({
+      'frame': index,
+      'fen': prediction.short_fen,
+      'certainty': float(prediction.certainty),
+      'move': inferMove(positions[-1]['fen'], prediction.short_fen)
+                if positions else None})
+
+  if stats is not None:
+    stats.update({
+      'frames': len(frame_keys),
+      'no_board': sum(key is None for key in frame_keys),
+      'unchanged': num_unchanged,
+      'repeats': num_repeats,
+      'classified': len(predictions),
+      'positions': len(positions),
+      'corners': None if corners is None else [int(c) for c in corners],
+    })
+  return positions
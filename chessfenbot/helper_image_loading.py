@@ -1,21 +1,67 @@
-import numpy as np
 
 # Imports for visualization
 import PIL.Image
 from io import BytesIO
+import threading
+from contextlib import closing
+from time import time
 try:
   # Python 3
-  from urllib.request import urlopen, Request
   from urllib.parse import quote
 except ImportError:
   # Python 2
-  from urllib2 import urlopen, Request
   from urllib2 import quote
 
 
 # Imports for pulling metadata from imgur url
+import codecs
+import re
 import requests
-from bs4 import BeautifulSoup
+try:
+  from html import unescape # Python 3
+except ImportError:
+  from HTMLParser import HTMLParser # Python 2
+  unescape = HTMLParser().unescape
+
+import caching
+
+# Downloads share one pooled requests session and are bounded by these limits
+# so a slow or unresponsive host can't stall the caller: seconds to connect,
+# seconds without receiving data, and seconds for the whole download
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+DOWNLOAD_TIMEOUT = 30
+# Most connections kept open per host, and concurrent downloads in
+# loadImagesFromURLs
+POOL_SIZE = 8
+USER_AGENT = 'TensorFlow Chessbot'
+
+_session = None
+
+# Imgur pages have the image url in a <meta name="twitter:image"> tag in their
+# <head>, at most this many bytes of a page are read looking for it
+HEAD_SCAN_BYTES = 256 * 1024
+META_TAG_RE = re.compile(r'<meta\b[^>]*>', re.IGNORECASE)
+# Longest <meta> tag that is still found when split between two chunks
+META_TAG_OVERLAP = 4096
+META_ATTR_RE = re.compile(r'([\w:-]+)\s*=\s*(["\'])(.*?)\2', re.DOTALL)
+
+_imgur_cache = None
+_image_cache = None
+
+def getSession():
+  """Return the shared requests session, with a pool of keep-alive
+  connections per host"""
+  global _session
+  if _session is None:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE,
+                                            pool_maxsize=POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    _session = session
+  return _session
 
 # All images are returned as PIL images, not numpy arrays
 def loadImageGrayscale(img_file):
@@ -25,80 +71,244 @@ def loadImageGrayscale(img_file):
   # Convert to grayscale and return
   return img.convert("L")
 
-def loadImageFromURL(url, max_size_bytes=4000000):
+def _download(url, max_size_bytes, session, deadline):
+  """Return the data at url, or None, see fetchURL"""
+  try:
+    with closing(session.get(url, stream=True,
+                             timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))) as response:
+      response.raise_for_status()
+      content_length = response.headers.get('Content-Length')
+      if content_length and content_length.isdigit() and \
+         int(content_length) > max_size_bytes:
+        print("Skipping, url data larger than %d bytes" % max_size_bytes)
+        return None
+
+      data = bytearray()
+      for chunk in response.iter_content(16 * 1024):
+        data += chunk
+        if len(data) > max_size_bytes:
+          print("Skipping, url data larger than %d bytes" % max_size_bytes)
+          return None
+        if time() > deadline:
+          return None
+      return bytes(data)
+  except requests.exceptions.RequestException as e:
+    print("Couldn't download url %s: %s" % (url, e))
+    return None
+
+def fetchURL(url, max_size_bytes=4000000, session=None):
+  """Return the data at url, or None if it couldn't be downloaded within the
+  timeouts or is larger than max_size_bytes.
+
+  A Content-Length above max_size_bytes fails before any of the body is
+  read, otherwise the body is streamed and abandoned once it grows past
+  max_size_bytes. The download runs in a daemon thread that is given up on
+  after DOWNLOAD_TIMEOUT seconds, so a host trickling data slower than
+  READ_TIMEOUT can't stall the caller either."""
+  session = session or getSession()
+  result = []
+
+  def download():
+    try:
+      result.append((_download(url, max_size_bytes, session,
+                               time() + DOWNLOAD_TIMEOUT), None))
+    except Exception as e:
+      # Raised again in the caller, not reported as a timeout
+      result.append((None, e))
+
+  thread = threading.Thread(target=download)
+  thread.daemon = True
+  thread.start()
+  thread.join(DOWNLOAD_TIMEOUT)
+  if not result:
+    print("Skipping, url took longer than %ds to download" % DOWNLOAD_TIMEOUT)
+    return None
+  data, error = result[0]
+  if error is not None:
+    raise error
+  return data
+
+def loadImageFromURL(url, max_size_bytes=4000000, session=None):
   """Load image from url.
 
   If the url has more data than max_size_bytes, fail out
-  Try and update with metadata url link if an imgur link"""
-  
-  # If imgur try to load from metadata
-  url = tryUpdateImgurURL(url)
-
-  # Try loading image from url directly
-  try:
-    req = Request(url, headers={'User-Agent' : "TensorFlow Chessbot"})
-    con = urlopen(req)
-    # Load up to max_size_bytes of data from url
-    data = con.read(max_size_bytes)
-    # If there is more, image is too big, skip
-    if len(con.read(1)) != 0:
-      print("Skipping, url data larger than %d bytes" % max_size_bytes)
+  Try and update with metadata url link if an imgur link
+  session: requests session to use, the shared pooled one by default
+  If an image cache is set with setImageCache, images already downloaded for
+  url are loaded from it, and offline ones don't download anything"""
+  cache = _image_cache
+  data = None
+  if cache is not None:
+    data, image_url = cache.get(url)
+    if data is None and cache.offline:
+      print("Skipping, url not in offline image cache: %s" % url)
       return None, url
+    if data is not None and len(data) > max_size_bytes:
+      print("Skipping, url data larger than %d bytes" % max_size_bytes)
+      return None, image_url
+
+  if data is None:
+    # If imgur try to load from metadata
+    image_url = tryUpdateImgurURL(url, session)
 
+    # Try loading image from url directly
+    data = fetchURL(image_url, max_size_bytes, session)
+    if data is None:
+      return None, image_url
+    if cache is not None:
+      cache.put(url, data, image_url)
+  try:
     # Process into PIL image
     img = PIL.Image.open(BytesIO(data))
     # Return PIL image and url used
-    return img, url
+    return img, image_url
   except IOError as e:
     # Return None on failure to load image from url
-    return None, url
+    return None, image_url
+
+def loadImagesFromURLs(urls, max_size_bytes=4000000, max_workers=POOL_SIZE,
+                       session=None):
+  """Load images from many urls concurrently in a pool of threads sharing
+  the pooled session, see loadImageFromURL.
+
+  Return list of (PIL image or None, url used, error) in input order, error
+  is None if the image loaded, else why it didn't, so one failed url doesn't
+  stop the others"""
+  from concurrent.futures import ThreadPoolExecutor
+
+  def load(url):
+    try:
+      img, image_url = loadImageFromURL(url, max_size_bytes, session)
+    except Exception as e:
+      return None, url, '%s: %s' % (type(e).__name__, e)
+    return img, image_url, None if img is not None else 'Couldn\'t load url'
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    return list(executor.map(load, urls))
+
+def findMetaContent(html, name):
+  """Return content of the <meta> tag with name (or property) name in html
+  text, None if there isn't one"""
+  for tag in META_TAG_RE.finditer(html):
+    attrs = dict((key.lower(), value) for key, _, value in
+                 META_ATTR_RE.findall(tag.group(0)))
+    if name in (attrs.get('name'), attrs.get('property')) and 'content' in attrs:
+      return unescape(attrs['content'])
+  return None
+
+def scanPageHead(url, meta_name, session=None):
+  """Return content of the meta_name <meta> tag in the page at url, None if
+  it isn't there. The page is streamed and only read up to the tag, the end
+  of its <head> or HEAD_SCAN_BYTES, whichever comes first.
+
+  Each chunk is decoded once, and only it plus the last META_TAG_OVERLAP
+  characters before it (for a tag split across chunks) are searched."""
+  session = session or getSession()
+  decoder = codecs.getincrementaldecoder('utf-8')('replace')
+  num_bytes = 0
+  html = ''
+  with closing(session.get(url, stream=True,
+                           timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))) as response:
+    response.raise_for_status()
+    for chunk in response.iter_content(8 * 1024):
+      num_bytes += len(chunk)
+      html = html[-META_TAG_OVERLAP:] + decoder.decode(chunk)
+      content = findMetaContent(html, meta_name)
+      if content is not None:
+        return content
+      if '</head>' in html.lower() or num_bytes >= HEAD_SCAN_BYTES:
+        break
+  return None
+
+def getImgurCache():
+  """Return the imgur page to image url cache, in-memory unless set with
+  setImgurCache"""
+  global _imgur_cache
+  if _imgur_cache is None:
+    _imgur_cache = caching.URLCache()
+  return _imgur_cache
+
+def setImgurCache(cache):
+  """Use cache (a caching.URLCache, ex. with a cache_dir to persist across
+  runs) for imgur page to image urls"""
+  global _imgur_cache
+  _imgur_cache = cache
+
+def setImageCache(cache):
+  """Use cache (a caching.ImageCache) for image bytes downloaded by
+  loadImageFromURL, None to always download"""
+  global _image_cache
+  _image_cache = cache
 
-def tryUpdateImgurURL(url):
-  """Try to get actual image url from imgur metadata"""
+def tryUpdateImgurURL(url, session=None):
+  """Try to get actual image url from imgur metadata, remembered in the
+  imgur cache so reprocessing a link doesn't load its page again"""
   if 'imgur' not in url: # Only attempt on urls that have imgur in it
     return url
 
-  soup = BeautifulSoup(requests.get(url).content, "lxml")
-  
-  # Get metadata tags
-  meta = soup.find_all('meta')
+  cache = getImgurCache()
+  image_url = cache.get(url)
+  if image_url is not None:
+    return image_url
+
   # Get the specific tag, ex.
   # <meta content="https://i.imgur.com/bStt0Fuh.jpg" name="twitter:image"/>
-  tags = list(filter(lambda tag: 'name' in tag.attrs and tag.attrs['name'] == "twitter:image", meta))
-  
-  if tags:
-    # Replace url with metadata url
-    url = tags[0]['content']
-  
-  return url
+  try:
+    image_url = scanPageHead(url, 'twitter:image', session) or url
+  except requests.exceptions.RequestException as e:
+    print("Couldn't load imgur metadata for %s: %s" % (url, e))
+    return url
+  cache.put(url, image_url)
+  return image_url
 
 def loadImageFromPath(img_path):
   """Load PIL image from image filepath, keep as color"""
   return PIL.Image.open(open(img_path,'rb'))
 
 
+# Largest downscale a JPEG can be decoded at in draft mode
+JPEG_DRAFT_SCALE = 8
+
+def getFitSize(size, max_size):
+  """Return size scaled down, keeping aspect ratio, to fit within max_size"""
+  ratio = min(1.0, float(max_size[0]) / size[0], float(max_size[1]) / size[1])
+  return (max(1, int(size[0] * ratio)), max(1, int(size[1] * ratio)))
+
 def resizeAsNeeded(img, max_size=(2000,2000), max_fail_size=(2000,2000)):
-  if not PIL.Image.isImageType(img):
+  """Return img shrunk to fit within max_size, or None if it can't be decoded
+  within max_fail_size.
+
+  PIL.Image.open only reads the header, so the checks here decode nothing.
+  JPEGs can be decoded directly at 1/2, 1/4 or 1/8 scale (draft mode), so
+  they are only rejected if even their 1/8 scale is larger than
+  max_fail_size, and are otherwise decoded at the smallest scale that still
+  covers max_size. Other formats larger than max_fail_size are rejected."""
+  if not isinstance(img, PIL.Image.Image):
     img = PIL.Image.fromarray(img) # Convert to PIL Image if not already
 
+  # Smallest size the image can be decoded at
+  min_scale = JPEG_DRAFT_SCALE if img.format == 'JPEG' else 1
+  min_size = [(side + min_scale - 1) // min_scale for side in img.size]
+
   # If image is larger than fail size, don't try resizing and give up
-  if img.size[0] > max_fail_size[0] or img.size[1] > max_fail_size[1]:
+  if min_size[0] > max_fail_size[0] or min_size[1] > max_fail_size[1]:
     return None
 
-  """Resize if image larger than max size"""
+  fit_size = getFitSize(img.size, max_size)
+  if fit_size != img.size and img.format == 'JPEG':
+    # Only has an effect before the image is loaded
+    img.draft(img.mode, fit_size)
+
   if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
     print("Image too big (%d x %d)" % (img.size[0], img.size[1]))
-    new_size = np.min(max_size) # px
-    if img.size[0] > img.size[1]:
-      # resize by width to new limit
-      ratio = np.float(new_size) / img.size[0]
-    else:
-      # resize by height
-      ratio = np.float(new_size) / img.size[1]
-    print("Reducing by factor of %.2g" % (1./ratio))
-    new_size = (np.array(img.size) * ratio).astype(int)
-    print("New size: (%d x %d)" % (new_size[0], new_size[1]))
-    img = img.resize(new_size, PIL.Image.BILINEAR)
+    print("Reducing by factor of %.2g" % (float(img.size[0]) / fit_size[0]))
+    print("New size: (%d x %d)" % fit_size)
+    # Box reduce whole factors first where available (Pillow >= 7.0), it is
+    # much cheaper than a bilinear resize over the full image
+    factor = min(img.size[0] // fit_size[0], img.size[1] // fit_size[1])
+    if factor >= 2 and hasattr(img, 'reduce'):
+      img = img.reduce(factor)
+    img = img.resize(fit_size, PIL.Image.BILINEAR)
   return img
 
 def getVisualizeLink(corners, url):
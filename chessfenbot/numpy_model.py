@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# NumPy-only forward pass of the piece classifier CNN, no TensorFlow needed
+#
+# Same network as save_graph.py:
+#   Input 32x32x1 -> 5x5 conv 32 + ReLU -> 2x2 max pool
+#                 -> 5x5 conv 64 + ReLU -> 2x2 max pool
+#                 -> 4096x1024 dense + ReLU -> 1024x13 dense -> softmax
+#
+# Weights are dicts of W1, B1, W2, B2, W3, B3, W5, B5 numpy arrays, loaded
+# either from the TensorFlow.js export in saved_models/web_model (manifest +
+# binary shards) or from a .npz file made with export_model.py --npz or
+# quantize_model.py --npz.
+#
+# A .npz can instead hold the compact student network made with
+# distill_model.py, marked by an 'architecture' entry of 'compact':
+#   Input 32x32x1 -> 3x3 conv + ReLU -> 2x2 max pool, repeated for each conv
+#                    weight W1, W2, ... (no pool after the last one)
+#                 -> global average pool -> dense -> softmax
+# with the layer widths read from the weight shapes.
+import json
+import os
+
+import numpy as np
+
+# Names of the CNN weights in the web model manifest / frozen graph
+WEIGHT_NAMES = {
+  'Variable': 'W1', 'Variable_1': 'B1', # 5x5x1x32 conv
+  'Variable_2': 'W2', 'Variable_3': 'B2', # 5x5x32x64 conv
+  'Variable_4': 'W3', 'Variable_5': 'B3', # 4096x1024 dense
+  'Variable_6': 'W5', 'Variable_7': 'B5', # 1024x13 readout
+}
+
+def loadWebModelWeights(model_dir):
+  """Return CNN weights dict from a TensorFlow.js weights_manifest.json and
+  its binary shards, all shards are concatenated in manifest order"""
+  with open(os.path.join(model_dir, 'weights_manifest.json')) as f:
+    manifest = json.load(f)
+
+  weights = {}
+  for group in manifest:
+    data = b''
+    for path in group['paths']:
+      shard_path = os.path.join(model_dir, path)
+      if not os.path.exists(shard_path):
+        raise IOError('Missing web model weight shard %s' % shard_path)
+      with open(shard_path, 'rb') as f:
+        data += f.read()
+
+    offset = 0
+    for entry in group['weights']:
+      shape = entry['shape']
+      size = int(np.prod(shape))
+      quantization = entry.get('quantization')
+      dtype = np.dtype(quantization['dtype'] if quantization else entry['dtype'])
+      values = np.frombuffer(data, dtype=dtype, count=size, offset=offset)
+      offset += size * dtype.itemsize
+
+      if quantization:
+        # Affine quantized weights, value = min + scale * q
+        values = quantization['min'] + quantization['scale'] * \
+                 values.astype(np.float32)
+      if entry['name'] in WEIGHT_NAMES:
+        weights[WEIGHT_NAMES[entry['name']]] = \
+          values.astype(np.float32).reshape(shape)
+  return weights
+
+def quantizeWeights(weights):
+  """Return copy of weights with each W matrix stored as symmetric int8 with
+  one float32 scale per output channel in <name>_scale, biases stay float32"""
+  quantized = {}
+  for name, value in weights.items():
+    if not name.startswith('W'):
+      quantized[name] = value
+      continue
+    # Output channel is the last axis for both HWIO conv and dense weights
+    max_abs = np.abs(value).reshape(-1, value.shape[-1]).max(axis=0)
+    scale = (np.maximum(max_abs, 1e-12) / 127).astype(np.float32)
+    quantized[name] = np.round(value / scale).astype(np.int8)
+    quantized[name + '_scale'] = scale
+  return quantized
+
+def dequantizeWeights(weights):
+  """Return float32 weights, expanding any int8 W with a <name>_scale"""
+  return {name: value.astype(np.float32) * weights[name + '_scale']
+            if name + '_scale' in weights else value
+          for name, value in weights.items() if not name.endswith('_scale')}
+
+def loadNpzWeights(npz_path):
+  """Return CNN weights dict from a .npz file, int8 quantized weights made
+  with quantize_model.py are dequantized on load"""
+  with np.load(npz_path) as data:
+    return dequantizeWeights({name: data[name] for name in data.files})
+
+def saveNpzWeights(weights, npz_path):
+  np.savez(npz_path, **weights)
+
+def loadWeights(model_path):
+  """Return CNN weights from a web model folder or .npz file"""
+  if os.path.isdir(model_path):
+    return loadWebModelWeights(model_path)
+  return loadNpzWeights(model_path)
+
+def getArchitecture(weights):
+  """Return 'compact' for distilled student weights, else 'cnn'"""
+  if 'architecture' in weights:
+    return str(weights['architecture'])
+  return 'cnn'
+
+def conv2dSame(x, W, b):
+  """Stride 1 'SAME' convolution of NHWC x with HWIO W plus bias b.
+
+  Patches are gathered with a strided view (im2col) and multiplied with the
+  flattened kernel in one matmul."""
+  n, h, w, c = x.shape
+  kh, kw, _, out_channels = W.shape
+  x_padded = np.pad(x, ((0, 0), (kh // 2, kh // 2), (kw // 2, kw // 2), (0, 0)),
+                    mode='constant')
+  s = x_padded.strides
+  patches = np.lib.stride_tricks.as_strided(x_padded,
+    shape=(n, h, w, kh, kw, c), strides=(s[0], s[1], s[2], s[1], s[2], s[3]))
+  out = patches.reshape(n * h * w, kh * kw * c).dot(
+    W.reshape(kh * kw * c, out_channels))
+  out += b
+  return out.reshape(n, h, w, out_channels)
+
+def maxPool2x2(x):
+  """2x2 max pool with stride 2 of NHWC x with even height and width"""
+  # Pairwise maximum of strided views is faster than a reshaped max reduction
+  rows_max = np.maximum(x[:, 0::2], x[:, 1::2])
+  return np.maximum(rows_max[:, :, 0::2], rows_max[:, :, 1::2])
+
+def relu(x):
+  return np.maximum(x, 0, out=x)
+
+def softmax(logits):
+  e = np.exp(logits - logits.max(axis=1, keepdims=True))
+  return e / e.sum(axis=1, keepdims=True)
+
+def forward(weights, rows, chunk_size=256):
+  """Return Nx13 probabilities for Nx1024 uint8 0-255 or normalized float32
+  tile rows.
+
+  Tiles are processed chunk_size at a time to bound the size of the im2col
+  patch matrices."""
+  # The first conv is linear in its input, so scaling uint8 rows to 0-1 is
+  # folded into its weights
+  W1 = weights['W1'] * np.float32(1.0 / 255.0) if rows.dtype == np.uint8 \
+       else weights['W1']
+  compact = getArchitecture(weights) == 'compact'
+  probabilities = np.empty([len(rows), 13], dtype=np.float32)
+  for start in range(0, len(rows), chunk_size):
+    x = rows[start:start+chunk_size].reshape(-1, 32, 32, 1).astype(
+      np.float32, copy=False)
+    if compact:
+      logits = compactLogits(weights, W1, x)
+    else:
+      h = maxPool2x2(relu(conv2dSame(x, W1, weights['B1'])))
+      h = maxPool2x2(relu(conv2dSame(h, weights['W2'], weights['B2'])))
+      h = relu(h.reshape(len(x), 8*8*64).dot(weights['W3']) + weights['B3'])
+      logits = h.dot(weights['W5']) + weights['B5']
+    probabilities[start:start+len(x)] = softmax(logits)
+  return probabilities
+
+def compactLogits(weights, W1, x):
+  """Return logits of the compact student network for NHWC x, W1 is the
+  (possibly rescaled) first conv weights"""
+  num_convs = sum(1 for name, value in weights.items()
+                  if name.startswith('W') and value.ndim == 4)
+  h = x
+  for i in range(1, num_convs + 1):
+    W = W1 if i == 1 else weights['W%d' % i]
+    h = relu(conv2dSame(h, W, weights['B%d' % i]))
+    if i < num_convs:
+      h = maxPool2x2(h)
+  h = h.mean(axis=(1, 2))
+  return h.dot(weights['W%d' % (num_convs + 1)]) + weights['B%d' % (num_convs + 1)]
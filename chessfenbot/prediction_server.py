@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# usage: prediction_server.py [-h] [--host HOST] [--port PORT]
+#                             [--backend {numpy,tf,tflite}]
+#                             [--model_path MODEL_PATH] [--threads THREADS]
+#                             [--max_batch_boards MAX_BATCH_BOARDS]
+#                             [--max_wait_ms MAX_WAIT_MS]
+#                             [--cache_dir CACHE_DIR] [--tile_cache TILE_CACHE]
+#
+# Long-running local prediction server sharing one loaded model
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   --host HOST           address to listen on (default 127.0.0.1)
+#   --port PORT           port to listen on (default 8765)
+#   --backend {numpy,tf,tflite}
+#                         model runtime (default tf)
+#   --model_path MODEL_PATH
+#                         model file for the backend
+#   --threads THREADS     threads per op for the tf and tflite backends
+#   --max_batch_boards MAX_BATCH_BOARDS
+#                         most boards run in one batch (default 16)
+#   --max_wait_ms MAX_WAIT_MS
+#                         how long a batch waits for more boards after the
+#                         first one arrives (default 5)
+#   --cache_dir CACHE_DIR
+#                         folder to cache found chessboard corners in
+#   --tile_cache TILE_CACHE
+#                         file to cache tile classifications in, shared with
+#                         other processes
+#
+# Loading the model costs seconds and hundreds of MB, so instead of every
+# process (chessbot.py, tensorflow_chessbot.py, cds_service.py) loading its
+# own, they can share this server over localhost HTTP:
+#
+#   POST /tiles   body is a .npy array (np.save) of one board's 64x1024 tiles,
+#                 or Bx64x1024 for B boards, uint8 or normalized float32,
+#                 returns each board's 64x13 probabilities
+#   POST /image   body is the bytes of an image file, the chessboard is found
+#                 on the server, returns probabilities and corners
+#   GET  /status  model and batching stats
+#
+# Responses are JSON. Boards from concurrent requests are coalesced into one
+# getPredictions call, a batch runs once max_batch_boards boards are queued or
+# max_wait_ms after its first board arrived.
+#
+# PredictionClient has the same interface as ChessboardPredictor, and
+# connectPredictor returns a client if a server is running, else loads a local
+# ChessboardPredictor, so call sites work either way.
+import argparse
+import inspect
+import io
+import json
+import threading
+from time import time
+try:
+  import queue
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+except ImportError: # Python 2
+  import Queue as queue
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+
+import numpy as np
+import PIL.Image
+import requests
+
+import caching
+import chessboard_finder
+import predictor_backends
+import tensorflow_chessbot
+
+DEFAULT_SERVER_ADDRESS = 'http://127.0.0.1:8765'
+
+class PendingBoard(object):
+  """One board's tiles waiting in the batch queue, and its result once run"""
+  def __init__(self, tiles):
+    self.tiles = tiles
+    self.result = None
+    self.error = None
+    self.done = threading.Event()
+
+class MicroBatcher(object):
+  """Coalesces boards submitted from many threads into batched predictions.
+
+  A worker thread takes the first queued board, then keeps collecting boards
+  until max_batch_boards are queued or max_wait seconds passed, and runs
+  them all in one predictor.getPredictions call."""
+  def __init__(self, predictor, max_batch_boards=16, max_wait=0.005):
+    self.predictor = predictor
+    self.max_batch_boards = max_batch_boards
+    self.max_wait = max_wait
+    self.queue = queue.Queue()
+    self.num_batches = 0
+    self.num_boards = 0
+    self.predict_seconds = 0.0
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def predict(self, tiles_list):
+    """Return list of BoardPrediction for boards, blocking until the batches
+    they were put in have run"""
+    pending = [PendingBoard(tiles) for tiles in tiles_list]
+    for board in pending:
+      self.queue.put(board)
+    for board in pending:
+      board.done.wait()
+      if board.error is not None:
+        raise board.error
+    return [board.result for board in pending]
+
+  def _run(self):
+    while True:
+      batch = [self.queue.get()]
+      deadline = time() + self.max_wait
+      while len(batch) < self.max_batch_boards:
+        remaining = deadline - time()
+        if remaining <= 0:
+          break
+        try:
+          batch.append(self.queue.get(timeout=remaining))
+        except queue.Empty:
+          break
+
+      a = time()
+      try:
+        results = self.predictor.getPredictions([board.tiles for board in batch])
+        for board, result in zip(batch, results):
+          board.result = result
+      except Exception:
+        # Run each board on its own so an error only reaches the request
+        # whose board caused it, not every request merged into the batch
+        for board in batch:
+          try:
+            board.result = self.predictor.getPredictions([board.tiles])[0]
+          except Exception as e:
+            board.error = e
+      self.predict_seconds += time() - a
+      self.num_batches += 1
+      self.num_boards += len(batch)
+      for board in batch:
+        board.done.set()
+
+  def getStats(self):
+    return {
+      'batches': self.num_batches,
+      'boards': self.num_boards,
+      'mean_batch_boards': self.num_boards / float(max(1, self.num_batches)),
+      'predict_seconds': self.predict_seconds,
+    }
+
+TILE_DTYPES = (np.uint8, np.float32)
+
+def checkBoards(boards):
+  """Raise ValueError unless every board is 64x1024 uint8 or float32 tiles"""
+  for board in boards:
+    if board.shape != (64, 32*32) or board.dtype not in TILE_DTYPES:
+      raise ValueError('Boards must be 64x1024 uint8 or float32 tiles, got '
+                       '%s %s' % ('x'.join(map(str, board.shape)), board.dtype))
+
+def predictionToJSON(prediction):
+  """Return BoardPrediction as JSON-able dict of its probabilities, which the
+  rest is computed from"""
+  if prediction is None:
+    return None
+  return {'probabilities': prediction.probabilities.tolist()}
+
+def predictionFromJSON(result):
+  if result is None or result.get('probabilities') is None:
+    return None
+  return tensorflow_chessbot.BoardPrediction(
+    np.array(result['probabilities'], dtype=np.float32))
+
+class PredictionHandler(BaseHTTPRequestHandler):
+  """HTTP handler, the server has batcher, finder_cache and model_info"""
+  protocol_version = 'HTTP/1.1' # Keep-alive for repeat clients
+
+  def _sendJSON(self, value, status=200):
+    body = json.dumps(value).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _readBody(self):
+    return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+  def do_GET(self):
+    if self.path != '/status':
+      return self._sendJSON({'error': 'Unknown path %s' % self.path}, 404)
+    stats = dict(self.server.model_info)
+    stats.update(self.server.batcher.getStats())
+    stats['finder_cache'] = self.server.finder_cache.getStats()
+    if self.server.tile_cache is not None:
+      stats['tile_cache'] = self.server.tile_cache.getStats()
+    self._sendJSON(stats)
+
+  def do_POST(self):
+    try:
+      body = self._readBody()
+      if self.path == '/tiles':
+        tiles = np.load(io.BytesIO(body), allow_pickle=False)
+        boards = [tiles] if tiles.ndim == 2 else list(tiles)
+        # Checked before batching, a bad board would fail the other
+        # requests' boards batched with it
+        checkBoards(boards)
+        results = self.server.batcher.predict(boards)
+        return self._sendJSON({'results': [predictionToJSON(r) for r in results]})
+      elif self.path == '/image':
+        img = PIL.Image.open(io.BytesIO(body))
+        tiles, corners = chessboard_finder.findGrayscaleTilesInImage(
+          img, cache=self.server.finder_cache)
+        if tiles is None:
+          return self._sendJSON({'probabilities': None, 'corners': None})
+        result = predictionToJSON(self.server.batcher.predict([tiles])[0])
+        result['corners'] = [int(c) for c in corners]
+        return self._sendJSON(result)
+      self._sendJSON({'error': 'Unknown path %s' % self.path}, 404)
+    except (ValueError, IOError, OSError) as e:
+      self._sendJSON({'error': 'Bad request: %s' % e}, 400)
+    except Exception as e:
+      self._sendJSON({'error': 'Prediction failed: %s' % e}, 500)
+
+  def log_message(self, format, *args):
+    pass # Don't print a line per request
+
+class PredictionServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, predictor, max_batch_boards=16, max_wait=0.005,
+               finder_cache=None):
+    HTTPServer.__init__(self, address, PredictionHandler)
+    self.batcher = MicroBatcher(predictor, max_batch_boards, max_wait)
+    self.finder_cache = finder_cache or caching.FinderCache()
+    self.tile_cache = predictor.tile_cache
+    self.model_info = {
+      'backend': predictor.backend_name,
+      'cold_latency': predictor.cold_latency,
+      'warm_latency': predictor.warm_latency,
+    }
+
+class PredictionClient(tensorflow_chessbot.ChessboardPredictor):
+  """Drop-in ChessboardPredictor that runs predictions on a prediction server.
+
+  getPrediction, getPredictions and makePrediction behave the same, image
+  loading and chessboard finding for makePrediction happen in this process."""
+  def __init__(self, server_address=DEFAULT_SERVER_ADDRESS, timeout=30):
+    self.server_address = server_address.rstrip('/')
+    self.timeout = timeout
+    # Tile caching, deduping and empty-tile checks all happen on the server
+    self.tile_cache = None
+    self.empty_fast_path = False
+    self.dedupe_tiles = False
+    self.session = requests.Session()
+    status = self.getStatus()
+    self.backend_name = status['backend']
+    self.cold_latency = status['cold_latency']
+    self.warm_latency = status['warm_latency']
+    print("\t Using %s model on prediction server %s" % (
+      self.backend_name, self.server_address))
+
+  def getStatus(self):
+    response = self.session.get(self.server_address + '/status',
+                                timeout=self.timeout)
+    response.raise_for_status()
+    return response.json()
+
+  def _post(self, path, data):
+    response = self.session.post(self.server_address + path, data=data,
+                                 timeout=self.timeout)
+    if response.status_code != 200:
+      raise Exception('Prediction server error %d: %s' % (
+        response.status_code, response.json().get('error')))
+    return response.json()
+
+  def getPredictions(self, tiles_list):
+    """Run the server's network on the tiles of many boards in one request"""
+    boards = []
+    for tiles in tiles_list:
+      if tiles is None or len(tiles) == 0:
+        continue
+      tiles = np.asarray(tiles)
+      # Send uint8 tiles as-is, 4x smaller than the float32 rows
+      boards.append(tiles.reshape(-1, 32*32) if tiles.dtype == np.uint8
+                    else tensorflow_chessbot.getTileRows(tiles))
+    if not boards:
+      return [None] * len(tiles_list)
+    if len(set(board.dtype for board in boards)) > 1:
+      boards = [tensorflow_chessbot.getTileRows(board) for board in boards]
+
+    f = io.BytesIO()
+    np.save(f, np.stack(boards))
+    results = iter(self._post('/tiles', f.getvalue())['results'])
+    return [None if tiles is None or len(tiles) == 0
+            else predictionFromJSON(next(results)) for tiles in tiles_list]
+
+  def getTileProbabilities(self, rows):
+    """Run the server's network on any number of tile rows, sent as boards
+    padded with blank tiles"""
+    rows = np.asarray(rows).reshape(-1, 32*32)
+    num_boards = (len(rows) + 63) // 64
+    boards = np.zeros([num_boards * 64, 32*32], dtype=rows.dtype)
+    boards[:len(rows)] = rows
+    predictions = self.getPredictions(list(boards.reshape(num_boards, 64, -1)))
+    return np.concatenate(
+      [prediction.probabilities for prediction in predictions])[:len(rows)]
+
+  def predictImage(self, image_bytes):
+    """Return (BoardPrediction, corners) for an image file's bytes, the
+    chessboard is found on the server, both None if there is no chessboard"""
+    result = self._post('/image', image_bytes)
+    if result['corners'] is None:
+      return None, None
+    return predictionFromJSON(result), np.array(result['corners'])
+
+  def close(self):
+    self.session.close()
+
+def getPredictorDefaults():
+  """Return dict of ChessboardPredictor.__init__ argument names to defaults"""
+  getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec # Python 2
+  spec = getargspec(tensorflow_chessbot.ChessboardPredictor.__init__)
+  return dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+
+def connectPredictor(server_address=DEFAULT_SERVER_ADDRESS, tile_cache_path=None,
+                     **predictor_kwargs):
+  """Return a PredictionClient if a prediction server is running at
+  server_address, else load a local ChessboardPredictor with predictor_kwargs,
+  and a caching.TileCache at tile_cache_path if given. The server has its own
+  model and caches, so predictor_kwargs and tile_cache_path are ignored when
+  it answers."""
+  if server_address:
+    try:
+      client = PredictionClient(server_address)
+      defaults = getPredictorDefaults()
+      ignored = sorted(name for name, value in predictor_kwargs.items()
+                       if value != defaults.get(name))
+      if tile_cache_path:
+        ignored.append('tile_cache')
+      if ignored:
+        print("\t Ignoring local predictor options, set on the server instead: %s"
+              % ', '.join(ignored))
+      return client
+    except requests.exceptions.RequestException:
+      print("\t No prediction server at %s, loading model locally" %
+            server_address)
+  if tile_cache_path:
+    predictor_kwargs['tile_cache'] = caching.TileCache(store_path=tile_cache_path)
+  return tensorflow_chessbot.ChessboardPredictor(**predictor_kwargs)
+
+def main(args):
+  tile_cache = caching.TileCache(store_path=args.tile_cache)
+  predictor = tensorflow_chessbot.ChessboardPredictor(
+    backend=args.backend, model_path=args.model_path,
+    intra_op_threads=args.threads, tile_cache=tile_cache)
+  finder_cache = caching.FinderCache(cache_dir=args.cache_dir)
+  server = PredictionServer((args.host, args.port), predictor,
+                            args.max_batch_boards, args.max_wait_ms / 1000.0,
+                            finder_cache)
+  print("Prediction server listening on http://%s:%d" % (args.host, args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    print("Keyboard Interrupt: Exiting...")
+  server.server_close()
+  predictor.close()
+  print(finder_cache)
+  print(tile_cache)
+  print("Ran %(boards)d boards in %(batches)d batches" %
+        server.batcher.getStats())
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Long-running local prediction server sharing one loaded model')
+  parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+  parser.add_argument('--port', type=int, default=8765, help='port to listen on (default 8765)')
+  parser.add_argument('--backend', default='tf', choices=sorted(predictor_backends.BACKENDS), help='model runtime (default tf)')
+  parser.add_argument('--model_path', help='model file for the backend')
+  parser.add_argument('--threads', type=int, help='threads per op for the tf and tflite backends')
+  parser.add_argument('--max_batch_boards', type=int, default=16, help='most boards run in one batch (default 16)')
+  parser.add_argument('--max_wait_ms', type=float, default=5, help='how long a batch waits for more boards after the first one arrives (default 5)')
+  parser.add_argument('--cache_dir', help='folder to cache found chessboard corners in')
+  parser.add_argument('--tile_cache', help='file to cache tile classifications in, shared with other processes')
+  args = parser.parse_args()
+  main(args)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Runtime backends for ChessboardPredictor
+#
+# Each backend loads the piece classifier CNN from one model format and maps
+# Nx1024 rows of uint8 0-255 or normalized float32 tiles to Nx13 piece
+# probabilities. uint8 rows are scaled at the model boundary: inside the graph
+# for models exported with export_model.py, folded into the first conv weights
+# for numpy, else just before feeding:
+#   'tf'      frozen TensorFlow graph (saved_models/frozen_graph.pb, or an
+#             optimized one made with export_model.py) in a tf.Session
+#   'tflite'  TFLite flatbuffer (saved_models/cf_v1.0.tflite, made with
+#             export_model.py) in the TFLite interpreter, uses the standalone
+#             tflite_runtime package if installed so TensorFlow isn't imported
+#   'numpy'   TensorFlow.js weights (saved_models/web_model) or a .npz made
+#             with export_model.py, run by the NumPy forward pass in
+#             numpy_model, needs no TensorFlow at all
+#
+# TensorFlow is only imported when a backend that needs it is created.
+#
+# intra_op_threads sets how many threads one op (conv/matmul) may use, and
+# inter_op_threads how many ops run in parallel (tf only), None leaves the
+# runtime defaults. The numpy backend's threads come from the BLAS library and
+# are set with environment variables like OMP_NUM_THREADS before importing.
+import numpy as np
+
+import numpy_model
+
+def load_graph(frozen_graph_filepath):
+    import tensorflow as tf
+    # Load and parse the protobuf file to retrieve the unserialized graph_def.
+    with tf.gfile.GFile(frozen_graph_filepath, "rb") as f:
+        graph_def = tf.GraphDef()
+        graph_def.ParseFromString(f.read())
+
+    # Import graph def and return.
+    with tf.Graph().as_default() as graph:
+        # Prefix every op/nodes in the graph.
+        tf.import_graph_def(graph_def, name="tcb")
+    return graph
+
+def toFloatRows(rows):
+  """Return rows as normalized float32, uint8 0-255 rows are scaled to 0-1"""
+  if rows.dtype == np.uint8:
+    return np.multiply(rows, 1.0 / 255.0, dtype=np.float32)
+  return rows.astype(np.float32, copy=False)
+
+def toUint8Rows(rows):
+  """Return rows as uint8 0-255, normalized float rows are scaled and rounded"""
+  if rows.dtype == np.uint8:
+    return rows
+  return np.clip(np.rint(rows * 255.0), 0, 255).astype(np.uint8)
+
+class FrozenGraphBackend(object):
+  """Runs a frozen TensorFlow graph in a tf.Session"""
+  def __init__(self, frozen_graph_path, intra_op_threads=None,
+               inter_op_threads=None):
+    import tensorflow as tf
+    graph = load_graph(frozen_graph_path)
+    config = tf.ConfigProto()
+    if intra_op_threads:
+      config.intra_op_parallelism_threads = intra_op_threads
+    if inter_op_threads:
+      config.inter_op_parallelism_threads = inter_op_threads
+    self.sess = tf.Session(graph=graph, config=config)
+
+    # Connect input/output pipes to model.
+    self.x = graph.get_tensor_by_name('tcb/Input:0')
+    # Exported graphs take uint8 tiles, save_graph.py ones normalized float32
+    self.uint8_input = self.x.dtype == tf.uint8
+    self.probabilities = graph.get_tensor_by_name('tcb/probabilities:0')
+    # Optimized graphs from export_model.py have no dropout to switch off
+    self.feed_dict = {}
+    if 'tcb/KeepProb' in [op.name for op in graph.get_operations()]:
+      self.feed_dict[graph.get_tensor_by_name('tcb/KeepProb:0')] = 1.0
+
+  def run(self, rows):
+    """Return Nx13 probabilities for Nx1024 uint8 or float32 rows"""
+    self.feed_dict[self.x] = toUint8Rows(rows) if self.uint8_input \
+                             else toFloatRows(rows)
+    return self.sess.run(self.probabilities, feed_dict=self.feed_dict)
+
+  def close(self):
+    self.sess.close()
+
+def loadTFLiteInterpreter(model_path, num_threads=None):
+  """Return TFLite interpreter for model_path, preferring the standalone
+  tflite_runtime package over importing all of TensorFlow"""
+  try:
+    from tflite_runtime.interpreter import Interpreter
+  except ImportError:
+    import tensorflow as tf
+    try:
+      Interpreter = tf.lite.Interpreter
+    except AttributeError:
+      Interpreter = tf.contrib.lite.Interpreter # TensorFlow < 1.13
+  if num_threads:
+    return Interpreter(model_path=model_path, num_threads=num_threads)
+  return Interpreter(model_path=model_path)
+
+class TFLiteBackend(object):
+  """Runs a TFLite model in the TFLite interpreter"""
+  def __init__(self, model_path, intra_op_threads=None, inter_op_threads=None):
+    self.interpreter = loadTFLiteInterpreter(model_path, intra_op_threads)
+    self.interpreter.allocate_tensors()
+    self.input_index = self.interpreter.get_input_details()[0]['index']
+    self.output_index = self.interpreter.get_output_details()[0]['index']
+    self.input_shape = tuple(self.interpreter.get_input_details()[0]['shape'])
+    self.uint8_input = \
+      self.interpreter.get_input_details()[0]['dtype'] == np.uint8
+
+  def run(self, rows):
+    """Return Nx13 probabilities for Nx1024 uint8 or float32 rows"""
+    rows = toUint8Rows(rows) if self.uint8_input else toFloatRows(rows)
+    # Model is exported for one board, resize for however many rows are fed
+    if rows.shape != self.input_shape:
+      self.interpreter.resize_tensor_input(self.input_index, rows.shape)
+      self.interpreter.allocate_tensors()
+      self.input_shape = rows.shape
+    self.interpreter.set_tensor(self.input_index, rows)
+    self.interpreter.invoke()
+    return self.interpreter.get_tensor(self.output_index)
+
+  def close(self):
+    self.interpreter = None
+
+class NumpyBackend(object):
+  """Runs the CNN forward pass in NumPy"""
+  def __init__(self, model_path, intra_op_threads=None, inter_op_threads=None):
+    self.weights = numpy_model.loadWeights(model_path)
+
+  def run(self, rows):
+    """Return Nx13 probabilities for Nx1024 uint8 or float32 rows"""
+    return numpy_model.forward(self.weights, rows)
+
+  def close(self):
+    self.weights = None
+
+BACKENDS = {
+  'tf': FrozenGraphBackend,
+  'tflite': TFLiteBackend,
+  'numpy': NumpyBackend,
+}
+
+DEFAULT_MODEL_PATHS = {
+  'tf': 'saved_models/frozen_graph.pb',
+  'tflite': 'saved_models/cf_v1.0.tflite',
+  'numpy': 'saved_models/web_model',
+}
+
+def loadBackend(backend='tf', model_path=None, intra_op_threads=None,
+                inter_op_threads=None):
+  """Return backend instance by name, loading model_path or its default"""
+  if backend not in BACKENDS:
+    raise ValueError('Unknown backend %r, expected one of %s' % (
+      backend, ', '.join(sorted(BACKENDS))))
+  if model_path is None:
+    model_path = DEFAULT_MODEL_PATHS[backend]
+  return BACKENDS[backend](model_path, intra_op_threads, inter_op_threads)
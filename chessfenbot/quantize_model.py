@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# usage: quantize_model.py [-h] [--model_path MODEL_PATH] [--npz NPZ]
+#                          [--tflite TFLITE] [--max_accuracy_drop MAX_ACCURACY_DROP]
+#                          [--num_calibration NUM_CALIBRATION]
+#                          [--max_tiles MAX_TILES]
+#                          tile_folder
+#
+# INT8 post-training quantization of the CNN, calibrated and evaluated on a
+# local tile corpus
+#
+# positional arguments:
+#   tile_folder           Folder of labeled 32x32 tiles named
+#                         <FEN>_<file><rank>.png like the training set
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   --model_path MODEL_PATH
+#                         Float32 model to quantize, a frozen graph .pb, .npz
+#                         or web model folder (default
+#                         saved_models/frozen_graph.pb)
+#   --npz NPZ             Output INT8 NumPy backend weights path (ex.
+#                         saved_models/cf_v1.0_int8.npz)
+#   --tflite TFLITE       Output INT8 TFLite model path (ex.
+#                         saved_models/cf_v1.0_int8.tflite)
+#   --max_accuracy_drop MAX_ACCURACY_DROP
+#                         Largest allowed drop in per-tile accuracy below
+#                         float32, as a fraction (default 0.005)
+#   --num_calibration NUM_CALIBRATION
+#                         Tiles used to calibrate activation ranges, the rest
+#                         are used for evaluation (default 512)
+#   --max_tiles MAX_TILES
+#                         Use at most this many tiles from the corpus
+#
+# For the NumPy backend the weight matrices are stored as int8 with a float32
+# scale per output channel, 4x smaller on disk, and expanded to float32 when
+# loaded. For TFLite the whole network is converted to int8 kernels, with
+# activation ranges calibrated on the calibration tiles. Each quantized model
+# is run by its backend on the evaluation tiles, and it is only written out if
+# its accuracy is within --max_accuracy_drop of the float32 model.
+import argparse
+import glob
+import os
+from time import time
+
+import numpy as np
+
+import helper_functions
+import numpy_model
+import predictor_backends
+
+def loadTileCorpus(tile_folder, max_tiles=None, seed=0):
+  """Return shuffled (Nx1024 uint8 rows, N label indices) of the labeled
+  tiles in tile_folder"""
+  # Tile filenames are the 71 character FEN, an underscore and the square
+  paths = np.array(sorted(path for path in glob.glob(os.path.join(tile_folder, '*.png'))
+                          if len(os.path.basename(path)) == 78))
+  np.random.RandomState(seed).shuffle(paths)
+  if max_tiles:
+    paths = paths[:max_tiles]
+  if not len(paths):
+    raise Exception('No labeled tiles found in %s' % tile_folder)
+  images, labels = helper_functions.loadFENtiles(paths)
+  rows = images.reshape(len(images), 32*32)
+  return rows, labels.argmax(axis=1)
+
+def loadFloatWeights(model_path):
+  """Return float32 CNN weights from a frozen graph, .npz or web model"""
+  if model_path.endswith('.pb'):
+    import export_model # Imports TensorFlow
+    return export_model.loadFrozenGraphWeights(model_path)
+  return numpy_model.loadWeights(model_path)
+
+def getAccuracy(run, rows, labels, batch_size=1024):
+  """Return (fraction of rows classified as labels, seconds per tile)"""
+  predictions = np.empty(len(rows), dtype=np.int64)
+  a = time()
+  for start in range(0, len(rows), batch_size):
+    predictions[start:start+batch_size] = run(rows[start:start+batch_size]).argmax(axis=1)
+  return (predictions == labels).mean(), (time() - a) / len(rows)
+
+def gateModel(backend, tmp_path, output_path, rows, labels, float_accuracy,
+              max_accuracy_drop):
+  """Evaluate quantized model at tmp_path, move it to output_path if its
+  accuracy is within max_accuracy_drop of float32, else delete it and raise"""
+  model = predictor_backends.loadBackend(backend, tmp_path)
+  accuracy, seconds_per_tile = getAccuracy(model.run, rows, labels)
+  model.close()
+  print("INT8 %s: accuracy %.4f (float32 %.4f), %.3f ms/tile, %d bytes" % (
+    backend, accuracy, float_accuracy, 1000 * seconds_per_tile,
+    os.path.getsize(tmp_path)))
+
+  if float_accuracy - accuracy > max_accuracy_drop:
+    os.remove(tmp_path)
+    raise Exception('INT8 %s model accuracy dropped %.4f, more than %.4f, not '
+      'writing %s' % (backend, float_accuracy - accuracy, max_accuracy_drop,
+                      output_path))
+  os.rename(tmp_path, output_path)
+  print("Wrote INT8 %s model to %s" % (backend, output_path))
+
+def main(args):
+  rows, labels = loadTileCorpus(args.tile_folder, args.max_tiles)
+  calibration_rows = rows[:args.num_calibration]
+  eval_rows, eval_labels = rows[args.num_calibration:], labels[args.num_calibration:]
+  if not len(eval_rows):
+    raise Exception('Need more than %d tiles to have some left for evaluation, '
+                    'got %d' % (args.num_calibration, len(rows)))
+  print("%d calibration tiles, %d evaluation tiles" % (
+    len(calibration_rows), len(eval_rows)))
+
+  weights = loadFloatWeights(args.model_path)
+  float_accuracy, seconds_per_tile = getAccuracy(
+    lambda r: numpy_model.forward(weights, r), eval_rows, eval_labels)
+  print("Float32: accuracy %.4f, %.3f ms/tile (numpy)" % (
+    float_accuracy, 1000 * seconds_per_tile))
+
+  if args.npz:
+    # np.savez appends .npz to paths without it
+    tmp_path = args.npz + '.tmp.npz'
+    numpy_model.saveNpzWeights(numpy_model.quantizeWeights(weights), tmp_path)
+    gateModel('numpy', tmp_path, args.npz, eval_rows, eval_labels,
+              float_accuracy, args.max_accuracy_drop)
+  if args.tflite:
+    import export_model # Imports TensorFlow
+    tmp_path = args.tflite + '.tmp'
+    export_model.exportTFLite(weights, tmp_path,
+                              representative_rows=calibration_rows)
+    gateModel('tflite', tmp_path, args.tflite, eval_rows, eval_labels,
+              float_accuracy, args.max_accuracy_drop)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='INT8 post-training quantization of the CNN, calibrated and evaluated on a local tile corpus')
+  parser.add_argument('tile_folder', help='Folder of labeled 32x32 tiles named <FEN>_<file><rank>.png like the training set')
+  parser.add_argument('--model_path', default='saved_models/frozen_graph.pb',
+                      help='Float32 model to quantize, a frozen graph .pb, .npz or web model folder (default saved_models/frozen_graph.pb)')
+  parser.add_argument('--npz', help='Output INT8 NumPy backend weights path (ex. saved_models/cf_v1.0_int8.npz)')
+  parser.add_argument('--tflite', help='Output INT8 TFLite model path (ex. saved_models/cf_v1.0_int8.tflite)')
+  parser.add_argument('--max_accuracy_drop', type=float, default=0.005,
+                      help='Largest allowed drop in per-tile accuracy below float32, as a fraction (default 0.005)')
+  parser.add_argument('--num_calibration', type=int, default=512,
+                      help='Tiles used to calibrate activation ranges, the rest are used for evaluation (default 512)')
+  parser.add_argument('--max_tiles', type=int, help='Use at most this many tiles from the corpus')
+  args = parser.parse_args()
+  main(args)
@@ -8,6 +8,17 @@
 #
 #   $ ./tensorflow_chessbot.py -h
 #   usage: tensorflow_chessbot.py [-h] [--url URL] [--filepath FILEPATH]
+#                                 [--cache_dir CACHE_DIR]
+#                                 [--tile_cache TILE_CACHE]
+#                                 [--backend {numpy,tf,tflite}]
+#                                 [--model_path MODEL_PATH]
+#                                 [--threads THREADS] [--empty_fast_path]
+#                                 [--refine_certainty REFINE_CERTAINTY]
+#                                 [--server SERVER]
+#                                 [--batch INPUT [INPUT ...]]
+#                                 [--output OUTPUT] [--processes PROCESSES]
+#                                 [--batch_boards BATCH_BOARDS]
+#                                 [--frames INPUT [INPUT ...]]
 # 
 #    Predict a chessboard FEN from supplied local image link or URL
 # 
@@ -15,6 +26,43 @@
 #      -h, --help           show this help message and exit
 #      --url URL            URL of image (ex. http://imgur.com/u4zF5Hj.png)
 #     --filepath FILEPATH  filepath to image (ex. u4zF5Hj.png)
+#     --cache_dir CACHE_DIR
+#                          folder to cache found chessboard corners in (ex.
+#                          finder_cache)
+#     --tile_cache TILE_CACHE
+#                          file to cache tile classifications in, shared with
+#                          other processes (ex. tile_cache.bin)
+#     --backend {numpy,tf,tflite}
+#                          model runtime (default tf)
+#     --model_path MODEL_PATH
+#                          model file for the backend (default
+#                          saved_models/frozen_graph.pb for tf)
+#     --threads THREADS    threads per op for the tf and tflite backends
+#                          (default all cores)
+#     --empty_fast_path    label flat empty squares without running the
+#                          network on them
+#     --refine_certainty REFINE_CERTAINTY
+#                          re-crop and classify again tiles below this
+#                          certainty, 0 to disable (default 0.9)
+#     --server SERVER      prediction server to use if running (ex.
+#                          http://127.0.0.1:8765), else the model is loaded
+#                          locally
+#     --batch INPUT [INPUT ...]
+#                          predict many images with one model load, inputs are
+#                          folders, glob patterns, .txt lists of paths or urls,
+#                          or paths and urls, writes one JSON line per image
+#     --output OUTPUT      file to write --batch or --frames JSON lines to
+#                          (default stdout)
+#     --processes PROCESSES
+#                          --batch worker processes loading images and finding
+#                          chessboards (default all cores)
+#     --batch_boards BATCH_BOARDS
+#                          --batch boards per inference batch (default 16)
+#     --frames INPUT [INPUT ...]
+#                          predict the positions in the frames of an animated
+#                          GIF or sequence of images of one chessboard, inputs
+#                          like --batch, writes one JSON line per distinct
+#                          position with the move from the previous one
 # 
 # This file is used by chessbot.py, a Reddit bot that listens on /r/chess for 
 # posts with an image in it (perhaps checking also for a statement 
@@ -38,70 +86,296 @@
 # A lot of tensorflow code here is heavily adopted from the 
 # [tensorflow tutorials](https://www.tensorflow.org/versions/0.6.0/tutorials/pdes/index.html)
 
+import contextlib
+import functools
+import glob
+import json
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' # Ignore Tensorflow INFO debug messages
-import tensorflow as tf
+import sys
+from time import time
 import numpy as np
 
 from helper_functions import shortenFEN
 import helper_image_loading
 import chessboard_finder
+import caching
+import predictor_backends
+# Used to be defined here, still importable as tensorflow_chessbot.load_graph
+from predictor_backends import load_graph
 
-def load_graph(frozen_graph_filepath):
-    # Load and parse the protobuf file to retrieve the unserialized graph_def.
-    with tf.gfile.GFile(frozen_graph_filepath, "rb") as f:
-        graph_def = tf.GraphDef()
-        graph_def.ParseFromString(f.read())
+def getTileRows(tiles):
+  """Return tiles as Nx1024 rows of input data, uint8 0-255 or normalized
+  float32.
 
-    # Import graph def and return.
-    with tf.Graph().as_default() as graph:
-        # Prefix every op/nodes in the graph.
-        tf.import_graph_def(graph_def, name="tcb")
-    return graph
+  Tiles in the 64x1024 rank-ordered layout from chessboard_finder are passed
+  through without copying, uint8 tiles stay uint8 to be scaled by the backend
+  at the model, other dtypes become float32, and legacy 32x32x64 tile stacks
+  are transposed into rows."""
+  tiles = np.asarray(tiles)
+  if tiles.shape == (32, 32, 64):
+    tiles = np.swapaxes(np.reshape(tiles, [32*32, 64]),0,1)
+  rows = np.reshape(tiles, [-1, 32*32])
+  if rows.dtype == np.uint8:
+    return rows
+  return rows.astype(np.float32, copy=False)
+
+def getUniqueRows(rows):
+  """Return (unique_rows, inverse) with unique_rows[inverse] == rows, rows
+  are compared by their raw bytes"""
+  rows = np.ascontiguousarray(rows)
+  keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1])))
+  _, index, inverse = np.unique(keys.ravel(), return_index=True,
+                                return_inverse=True)
+  return rows[index], inverse.ravel()
+
+def getEmptyTileMask(rows, max_energy=0.005, relative_energy=0.1,
+                     max_range=0.05, max_mean_diff=0.1):
+  """Return boolean mask of which of one board's 64 normalized tile rows are
+  confidently empty squares.
+
+  Only the tile centers are looked at, leaving out borders where grid lines
+  and coordinate labels show. A tile is flat if its edge energy (mean absolute
+  gradient) is at most the smaller of max_energy and relative_energy times
+  the busiest tile's energy on the board, and its brightness range is at most
+  max_range. Flat tiles are empty if their mean brightness is within
+  max_mean_diff of the median flat tile of the same square color, so
+  highlighted squares, textured boards and faint pieces go to the CNN."""
+  tiles = rows.reshape(-1, 32, 32)[:, 4:28, 4:28]
+  if tiles.dtype == np.uint8:
+    tiles = np.multiply(tiles, 1.0 / 255.0, dtype=np.float32)
+  energy = np.abs(np.diff(tiles, axis=1)).mean(axis=(1, 2)) + \
+           np.abs(np.diff(tiles, axis=2)).mean(axis=(1, 2))
+  flat = (energy <= min(max_energy, relative_energy * energy.max())) & \
+         (tiles.max(axis=(1, 2)) - tiles.min(axis=(1, 2)) <= max_range)
+  means = tiles.mean(axis=(1, 2))
+  # Rank-ordered A1-H8, A1 and every other square from it are dark
+  square_color = (np.arange(len(rows)) + np.arange(len(rows)) // 8) % 2
+  empty = np.zeros(len(rows), dtype=bool)
+  for color in (0, 1):
+    candidates = flat & (square_color == color)
+    if candidates.any():
+      empty |= candidates & (
+        np.abs(means - np.median(means[candidates])) <= max_mean_diff)
+  return empty
+
+# Tiles below this certainty are re-cropped and classified again by
+# ChessboardPredictor.refinePrediction, at most MAX_REFINE_TILES per board
+REFINE_CERTAINTY = 0.9
+MAX_REFINE_TILES = 8
+
+# FEN character of each label index, '1' for an empty square
+FEN_PIECE_NAMES = np.array(list('1KQRBNPkqrbnp'))
+
+class BoardPrediction(object):
+  """Prediction for one board, everything callers need computed once.
+
+  probabilities: 64x13 network output, tiles in rank-order A1-H8
+  labels: 64 most likely label indices, rank-order A1-H8
+  top2_labels, top2_probabilities: 64x2 best and second best label indices
+    and their probabilities per tile, rank-order A1-H8
+  tile_certainties: 8x8 probability of each chosen label, in FEN order (rank
+    8 first), as printed by the CLI
+  fen: full 71 character FEN board ('111pq11r/...'), short_fen: shortened
+  certainty, max_certainty, mean_certainty: min/max/mean of tile_certainties
+  refined_tiles: rank-order indices of tiles re-classified by
+    ChessboardPredictor.refinePrediction
+
+  Unpacks as (fen, tile_certainties) like the tuples getPrediction returned
+  before."""
+  def __init__(self, probabilities, refined_tiles=()):
+    self.probabilities = probabilities
+    self.refined_tiles = np.asarray(refined_tiles, dtype=int)
+    tile_index = np.arange(len(probabilities))
+    self.top2_labels = np.argsort(-probabilities, axis=1)[:, :2]
+    self.top2_probabilities = probabilities[tile_index[:, None], self.top2_labels]
+    self.labels = self.top2_labels[:, 0]
+
+    # Rank-order A1-H8 to FEN order is flipping the ranks
+    self.tile_certainties = self.top2_probabilities[:, 0].reshape([8, 8])[::-1, :]
+    self.certainty = self.tile_certainties.min()
+    self.max_certainty = self.tile_certainties.max()
+    self.mean_certainty = self.tile_certainties.mean()
+
+    # View each rank of 8 single characters as one 8 character string
+    ranks = np.ascontiguousarray(FEN_PIECE_NAMES[self.labels].reshape([8, 8])[::-1])
+    self.fen = '/'.join(ranks.view('<U8').ravel())
+    self.short_fen = shortenFEN(self.fen)
+
+  def __iter__(self):
+    return iter((self.fen, self.tile_certainties))
 
 class ChessboardPredictor(object):
   """ChessboardPredictor using saved model"""
-  def __init__(self, frozen_graph_path='saved_models/frozen_graph.pb'):
-    # Restore model using a frozen graph.
-    print("\t Loading model '%s'" % frozen_graph_path)
-    graph = load_graph(frozen_graph_path)
-    self.sess = tf.Session(graph=graph)
-
-    # Connect input/output pipes to model.
-    self.x = graph.get_tensor_by_name('tcb/Input:0')
-    self.keep_prob = graph.get_tensor_by_name('tcb/KeepProb:0')
-    self.prediction = graph.get_tensor_by_name('tcb/prediction:0')
-    self.probabilities = graph.get_tensor_by_name('tcb/probabilities:0')
+  def __init__(self, frozen_graph_path='saved_models/frozen_graph.pb',
+               backend='tf', model_path=None, intra_op_threads=None,
+               inter_op_threads=None, cpu_affinity=None, warmup=True,
+               empty_fast_path=False, dedupe_tiles=True, tile_cache=None):
+    # backend: 'tf' runs the frozen graph at frozen_graph_path in a tf.Session,
+    # 'tflite' runs model_path (default saved_models/cf_v1.0.tflite) in the
+    # TFLite interpreter, 'numpy' runs model_path (default
+    # saved_models/web_model) without TensorFlow, see predictor_backends
+    # intra_op_threads/inter_op_threads: runtime thread pool sizes, None for
+    #   the runtime defaults (all cores)
+    # cpu_affinity: optional list of CPU ids to pin this process to (Linux),
+    #   keeps inference off the cores used by other programs like a chess client
+    # warmup: run one board at load so the first real prediction doesn't pay
+    #   graph initialization and allocation costs
+    # empty_fast_path: label tiles getEmptyTileMask finds confidently empty
+    #   directly and only run the rest through the network
+    # dedupe_tiles: run pixel-identical tiles (like empty squares of one color)
+    #   through the network once and copy the result to the others
+    # tile_cache: optional caching.TileCache, tiles seen before (in this or
+    #   another process sharing its store) reuse their cached probabilities
+    if backend == 'tf' and model_path is None:
+      model_path = frozen_graph_path
+    if cpu_affinity:
+      if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_affinity)
+      else:
+        print("\t CPU affinity not supported on this platform, ignoring")
+    self.backend_name = backend
+    self.empty_fast_path = empty_fast_path
+    self.dedupe_tiles = dedupe_tiles
+    self.tile_cache = tile_cache
+    print("\t Loading %s model '%s'" % (backend,
+      model_path or predictor_backends.DEFAULT_MODEL_PATHS.get(backend)))
+    self.backend = predictor_backends.loadBackend(backend, model_path,
+      intra_op_threads, inter_op_threads)
+    # Identifies the model in tile cache keys
+    model_path = model_path or predictor_backends.DEFAULT_MODEL_PATHS[backend]
+    self.model_tag = '%s %s %d' % (backend, os.path.abspath(model_path),
+      os.path.getsize(model_path) if os.path.isfile(model_path) else 0)
     print("\t Model restored.")
 
+    # Seconds for the first and a later one board inference, None until warmed up
+    self.cold_latency = None
+    self.warm_latency = None
+    if warmup:
+      self.warmup()
+
+  def warmup(self):
+    """Run inference twice on a blank board, recording cold and warm latency"""
+    rows = np.zeros([64, 32*32], dtype=np.uint8)
+    a = time()
+    self.backend.run(rows)
+    self.cold_latency = time() - a
+    a = time()
+    self.backend.run(rows)
+    self.warm_latency = time() - a
+    print("\t Warm-up: cold %.1f ms, warm %.1f ms per board" % (
+      1000 * self.cold_latency, 1000 * self.warm_latency))
+
   def getPrediction(self, tiles):
-    """Run trained neural network on tiles generated from image"""
+    """Run trained neural network on tiles generated from image, return a
+    BoardPrediction, or (None, 0.0) as before if there are no tiles"""
     if tiles is None or len(tiles) == 0:
       print("Couldn't parse chessboard")
       return None, 0.0
-    
-    # Reshape into Nx1024 rows of input data, format used by neural network
-    validation_set = np.swapaxes(np.reshape(tiles, [32*32, 64]),0,1)
+    return self.getPredictions([tiles])[0]
+
+  def getPredictions(self, tiles_list):
+    """Run trained neural network on the tiles of many boards at once.
+
+    All boards are concatenated into a single N*64 x 1024 feed so the session
+    dispatch overhead is paid once. Returns a list of BoardPrediction per
+    board, None for boards without tiles."""
+    boards = [getTileRows(tiles) for tiles in tiles_list
+              if tiles is not None and len(tiles) > 0]
+    if not boards:
+      return [None] * len(tiles_list)
+
+    # Nx1024 rows of input data, format used by neural network, kept uint8
+    # unless some boards came as floats
+    if len(set(rows.dtype for rows in boards)) > 1:
+      boards = [predictor_backends.toFloatRows(rows) for rows in boards]
+    validation_set = np.concatenate(boards) if len(boards) > 1 else boards[0]
 
     # Run neural network on data
-    guess_prob, guessed = self.sess.run(
-      [self.probabilities, self.prediction], 
-      feed_dict={self.x: validation_set, self.keep_prob: 1.0})
-    
-    # Prediction bounds
-    a = np.array(list(map(lambda x: x[0][x[1]], zip(guess_prob, guessed))))
-    tile_certainties = a.reshape([8,8])[::-1,:]
+    if self.empty_fast_path:
+      empty = np.concatenate([getEmptyTileMask(rows) for rows in boards])
+      guess_prob = np.zeros([len(validation_set), 13], dtype=np.float32)
+      guess_prob[empty, 0] = 1.0
+      if not empty.all():
+        guess_prob[~empty] = self.runTileRows(validation_set[~empty])
+    else:
+      guess_prob = self.runTileRows(validation_set)
+
+    # Split results back out per board
+    results = []
+    i = 0
+    for tiles in tiles_list:
+      if tiles is None or len(tiles) == 0:
+        results.append(None)
+        continue
+      results.append(BoardPrediction(guess_prob[i:i+64]))
+      i += 64
+    return results
+
+  def refinePrediction(self, prediction, img, corners,
+                       min_certainty=REFINE_CERTAINTY, max_tiles=MAX_REFINE_TILES):
+    """Return prediction with its least certain tiles classified again.
+
+    Up to max_tiles tiles below min_certainty are re-cropped from img (PIL
+    image or grayscale array the tiles came from) at the sub-pixel shifts and
+    scales of chessboard_finder.TILE_JITTERS, all crops are run in one extra
+    inference, and each tile keeps whichever of its original and re-cropped
+    probabilities is most confident. The extra cost is len(TILE_JITTERS)
+    tiles per uncertain tile, nothing if all tiles are certain."""
+    if not isinstance(prediction, BoardPrediction):
+      return prediction # No board, None or getPrediction's (None, 0.0)
+    certainties = prediction.top2_probabilities[:, 0]
+    uncertain = np.flatnonzero(certainties < min_certainty)
+    if not len(uncertain):
+      return prediction
+    uncertain = uncertain[np.argsort(certainties[uncertain])[:max_tiles]]
+
+    if not isinstance(img, np.ndarray):
+      img = np.asarray(img.convert("L"))
+    jitters = chessboard_finder.TILE_JITTERS
+    rows = chessboard_finder.getJitteredTiles(img, corners, uncertain, jitters)
+    votes = self.getTileProbabilities(rows).reshape(
+      len(uncertain), len(jitters), 13)
 
-    # Convert guess into FEN string
-    # guessed is tiles A1-H8 rank-order, so to make a FEN we just need to flip the files from 1-8 to 8-1
-    labelIndex2Name = lambda label_index: ' KQRBNPkqrbnp'[label_index]
-    pieceNames = list(map(lambda k: '1' if k == 0 else labelIndex2Name(k), guessed)) # exchange ' ' for '1' for FEN
-    fen = '/'.join([''.join(pieceNames[i*8:(i+1)*8]) for i in reversed(range(8))])
-    return fen, tile_certainties
+    # Vote between the original crop and the re-crops of each tile
+    votes = np.concatenate([prediction.probabilities[uncertain, None], votes],
+                           axis=1)
+    best = votes.max(axis=2).argmax(axis=1)
+    probabilities = prediction.probabilities.copy()
+    probabilities[uncertain] = votes[np.arange(len(uncertain)), best]
+    return BoardPrediction(probabilities, refined_tiles=uncertain)
+
+  def getTileProbabilities(self, rows):
+    """Return Nx13 probabilities for any number of Nx1024 tile rows"""
+    return self.runTileRows(getTileRows(rows))
+
+  def runTileRows(self, rows):
+    """Return Nx13 probabilities for Nx1024 rows from the backend, running
+    duplicate rows only once if dedupe_tiles is set, and only rows missing
+    from the tile cache if there is one"""
+    if not self.dedupe_tiles:
+      return self.runCachedRows(rows)
+    unique_rows, inverse = getUniqueRows(rows)
+    if len(unique_rows) == len(rows):
+      return self.runCachedRows(rows)
+    return self.runCachedRows(unique_rows)[inverse]
+
+  def runCachedRows(self, rows):
+    if self.tile_cache is None:
+      return self.backend.run(rows)
+    keys = self.tile_cache.getKeys(rows, self.model_tag)
+    probabilities, found = self.tile_cache.lookup(keys)
+    if not found.all():
+      missing = np.flatnonzero(~found)
+      probabilities[missing] = self.backend.run(rows[missing])
+      self.tile_cache.put([keys[i] for i in missing], probabilities[missing])
+    return probabilities
 
   ## Wrapper for chessbot
-  def makePrediction(self, url):
-    """Try and return a FEN prediction and certainty for URL, return Nones otherwise"""
+  def makePrediction(self, url, finder_cache=None):
+    """Try and return a FEN prediction and certainty for URL, return Nones otherwise
+
+    finder_cache: optional caching.FinderCache to reuse corners of seen images"""
     img, url = helper_image_loading.loadImageFromURL(url, max_size_bytes=2000000)
     result = [None, None, None]
     
@@ -119,34 +393,213 @@ class ChessboardPredictor(object):
       return result
 
     # Look for chessboard in image, get corners and split chessboard into tiles
-    tiles, corners = chessboard_finder.findGrayscaleTilesInImage(img)
+    tiles, corners = chessboard_finder.findGrayscaleTilesInImage(
+      img, cache=finder_cache)
 
     # Exit on failure to find chessboard in image
     if tiles is None:
       print('Couldn\'t find chessboard in image')
       return result
     
-    # Make prediction on input tiles
-    fen, tile_certainties = self.getPrediction(tiles)
-    
-    # Use the worst case certainty as our final uncertainty score
-    certainty = tile_certainties.min()
+    # Make prediction on input tiles, giving uncertain tiles a second look
+    prediction = self.refinePrediction(self.getPrediction(tiles), img, corners)
 
     # Get visualize link
     visualize_link = helper_image_loading.getVisualizeLink(corners, url)
 
-    # Update result and return
-    result = [fen, certainty, visualize_link]
+    # Update result and return, the worst case tile certainty is our final
+    # uncertainty score
+    result = [prediction.fen, prediction.certainty, visualize_link]
     return result
 
   def close(self):
     print("Closing session.")
-    self.sess.close()
+    self.backend.close()
 
 ###########################################################
 # MAIN CLI
 
+def loadPredictor(args):
+  """Return ChessboardPredictor (or prediction server client) and tile cache
+  for the CLI args, the tile cache is None when a server answers"""
+  if args.server:
+    import prediction_server
+    predictor = prediction_server.connectPredictor(args.server,
+      tile_cache_path=args.tile_cache, backend=args.backend,
+      model_path=args.model_path, intra_op_threads=args.threads,
+      empty_fast_path=args.empty_fast_path)
+  else:
+    tile_cache = None
+    if args.tile_cache:
+      tile_cache = caching.TileCache(store_path=args.tile_cache)
+    predictor = ChessboardPredictor(backend=args.backend,
+                                    model_path=args.model_path,
+                                    intra_op_threads=args.threads,
+                                    empty_fast_path=args.empty_fast_path,
+                                    tile_cache=tile_cache)
+  return predictor, predictor.tile_cache
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
+def iterInputImages(inputs):
+  """Yield image paths and urls from a list of directories (their images),
+  glob patterns, list files (.txt, one path or url per line) and single
+  paths or urls"""
+  for name in inputs:
+    if os.path.isdir(name):
+      for filename in sorted(os.listdir(name)):
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+          yield os.path.join(name, filename)
+    elif name.endswith('.txt') and os.path.isfile(name):
+      with open(name) as f:
+        for line in f:
+          line = line.strip()
+          if line and not line.startswith('#'):
+            yield line
+    elif any(c in name for c in '*?[') and not name.startswith('http'):
+      for path in sorted(glob.glob(name)):
+        yield path
+    else:
+      yield name
+
+def _findTilesTimed(image, keep_board=False):
+  """Return (tiles, corners, board, error, seconds) for one image, run inside
+  pool workers, timing includes loading and decoding the image. board is the
+  (crop, corners) of chessboard_finder.getBoardCrop if keep_board and a board
+  was found, so uncertain boards can be refined without loading the image
+  again, else None"""
+  a = time()
+  try:
+    img = chessboard_finder.loadImage(image)
+    tiles, corners = chessboard_finder.findGrayscaleTilesInImage(img)
+    board = None
+    if keep_board and tiles is not None:
+      board = chessboard_finder.getBoardCrop(np.asarray(img.convert("L")),
+                                             corners)
+    return tiles, corners, board, None, time() - a
+  except Exception as e:
+    return None, None, None, '%s: %s' % (type(e).__name__, e), time() - a
+
+def runBatch(predictor, images, output, processes=None, batch_boards=16,
+             refine_certainty=REFINE_CERTAINTY):
+  """Predict every image, writing one JSON line per image to output as
+  results complete, in input order.
+
+  Image loading and chessboard finding run in a pool of processes, while
+  the model in this process runs batches of up to batch_boards found boards
+  at a time. Each line has the image path, FEN, certainty, corners, error
+  and per-stage seconds. When refining, the workers also send back the
+  grayscale pixels around each board for the uncertain ones."""
+  worker = functools.partial(_findTilesTimed, keep_board=refine_certainty > 0)
+  results = chessboard_finder.iterBatch(worker, images, processes,
+                                        max_pending=max(2 * batch_boards, 8))
+  pending = []
+  num_images = 0
+  num_boards = 0
+  a = time()
+
+  def flush():
+    boards = [item for item in pending if item[1] is not None]
+    predictions = iter([])
+    predict_seconds = 0.0
+    if boards:
+      b = time()
+      predictions = iter(predictor.getPredictions(
+        [tiles for _, tiles, _, _, _, _ in boards]))
+      predict_seconds = (time() - b) / len(boards)
+    for image, tiles, corners, board, error, find_seconds in pending:
+      record = {'path': image, 'fen': None, 'certainty': None,
+                'corners': None, 'error': error,
+                'seconds': {'find': round(find_seconds, 4)}}
+      if tiles is None:
+        if error is None:
+          record['error'] = 'No chessboard found'
+      else:
+        prediction = next(predictions)
+        refine_seconds = 0.0
+        if prediction.certainty < refine_certainty:
+          # Re-crop from the pixels the worker kept, not a second download
+          b = time()
+          crop, crop_corners = board
+          prediction = predictor.refinePrediction(prediction, crop, crop_corners,
+                                                  refine_certainty)
+          refine_seconds = time() - b
+        record.update({'fen': prediction.short_fen,
+                       'certainty': float(prediction.certainty),
+                       'corners': [int(c) for c in corners]})
+        record['seconds']['predict'] = round(predict_seconds, 4)
+        if refine_seconds:
+          record['seconds']['refine'] = round(refine_seconds, 4)
+      output.write(json.dumps(record) + '\n')
+    output.flush()
+    del pending[:]
+
+  for image, (tiles, corners, board, error, find_seconds) in zip(images, results):
+    pending.append((image, tiles, corners, board, error, find_seconds))
+    num_images += 1
+    if tiles is not None:
+      num_boards += 1
+    if sum(item[1] is not None for item in pending) >= batch_boards:
+      flush()
+  flush()
+  print("Found boards in %d/%d images, %.1f images/s" % (
+    num_boards, num_images, num_images / max(time() - a, 1e-9)))
+
+def mainBatch(args):
+  # JSON lines go to stdout unless an output file is given, everything else
+  # printed goes to stderr so the output stays parseable
+  output = sys.stdout if args.output == '-' else open(args.output, 'w')
+  try:
+    with contextlib.redirect_stdout(sys.stderr):
+      predictor, tile_cache = loadPredictor(args)
+      # Consumed once by both the worker pool and the output loop
+      images = list(iterInputImages(args.batch))
+      try:
+        runBatch(predictor, images, output, args.processes, args.batch_boards,
+                 args.refine_certainty)
+      finally:
+        predictor.close()
+      if tile_cache is not None:
+        print(tile_cache)
+  finally:
+    if output is not sys.stdout:
+      output.close()
+
+def mainFrames(args):
+  import frame_sequence
+  # Same output handling as --batch
+  output = sys.stdout if args.output == '-' else open(args.output, 'w')
+  try:
+    with contextlib.redirect_stdout(sys.stderr):
+      predictor, tile_cache = loadPredictor(args)
+      stats = {}
+      a = time()
+      try:
+        positions = frame_sequence.predictFrameSequence(predictor,
+          list(iterInputImages(args.frames)), args.batch_boards,
+          args.refine_certainty, stats)
+      finally:
+        predictor.close()
+      seconds = time() - a
+      for position in positions:
+        output.write(json.dumps(position) + '\n')
+      print("%d frames (%d unchanged, %d repeats, %d without a board), "
+            "%d boards classified, %d positions, %.1f frames/s" % (
+        stats['frames'], stats['unchanged'], stats['repeats'],
+        stats['no_board'], stats['classified'], stats['positions'],
+        stats['frames'] / max(seconds, 1e-9)))
+      if tile_cache is not None:
+        print(tile_cache)
+  finally:
+    if output is not sys.stdout:
+      output.close()
+
 def main(args):
+  if args.batch:
+    return mainBatch(args)
+  if args.frames:
+    return mainFrames(args)
+
   # Load image from filepath or URL
   if args.filepath:
     # Load image from file
@@ -162,8 +615,16 @@ def main(args):
   # Resize image if too large
   # img = helper_image_loading.resizeAsNeeded(img)
 
+  # Optionally reuse corners found for the same image on previous runs
+  finder_cache = None
+  if args.cache_dir:
+    finder_cache = caching.FinderCache(cache_dir=args.cache_dir)
+
   # Look for chessboard in image, get corners and split chessboard into tiles
-  tiles, corners = chessboard_finder.findGrayscaleTilesInImage(img)
+  tiles, corners = chessboard_finder.findGrayscaleTilesInImage(
+    img, cache=finder_cache)
+  if finder_cache is not None:
+    print(finder_cache)
 
   # Exit on failure to find chessboard in image
   if tiles is None:
@@ -179,21 +640,26 @@ def main(args):
   else:
     print("\n--- Prediction on file %s ---" % args.filepath)
   
-  # Initialize predictor, takes a while, but only needed once
-  predictor = ChessboardPredictor()
-  fen, tile_certainties = predictor.getPrediction(tiles)
+  # Initialize predictor, takes a while, but only needed once. Uses a running
+  # prediction server instead if one was given
+  predictor, tile_cache = loadPredictor(args)
+  prediction = predictor.getPrediction(tiles)
+  if args.refine_certainty > 0:
+    prediction = predictor.refinePrediction(prediction, img, corners,
+                                            args.refine_certainty)
+    print("Refined %d uncertain tiles" % len(prediction.refined_tiles))
   predictor.close()
-  short_fen = shortenFEN(fen)
-  # Use the worst case certainty as our final uncertainty score
-  certainty = tile_certainties.min()
+  if tile_cache is not None:
+    print(tile_cache)
 
   print('Per-tile certainty:')
-  print(tile_certainties)
+  print(prediction.tile_certainties)
   print("Certainty range [%g - %g], Avg: %g" % (
-    tile_certainties.min(), tile_certainties.max(), tile_certainties.mean()))
+    prediction.certainty, prediction.max_certainty, prediction.mean_certainty))
 
-  print("---\nPredicted FEN: %s" % short_fen)
-  print("Final Certainty: %.1f%%" % (certainty*100))
+  print("---\nPredicted FEN: %s" % prediction.short_fen)
+  # Use the worst case certainty as our final uncertainty score
+  print("Final Certainty: %.1f%%" % (prediction.certainty*100))
 
 if __name__ == '__main__':
   np.set_printoptions(suppress=True, precision=3)
@@ -201,6 +667,19 @@ if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='Predict a chessboard FEN from supplied local image link or URL')
   parser.add_argument('--url', default='http://imgur.com/u4zF5Hj.png', help='URL of image (ex. http://imgur.com/u4zF5Hj.png)')
   parser.add_argument('--filepath', help='filepath to image (ex. u4zF5Hj.png)')
+  parser.add_argument('--cache_dir', help='folder to cache found chessboard corners in (ex. finder_cache)')
+  parser.add_argument('--tile_cache', help='file to cache tile classifications in, shared with other processes (ex. tile_cache.bin)')
+  parser.add_argument('--backend', default='tf', choices=sorted(predictor_backends.BACKENDS), help='model runtime (default tf)')
+  parser.add_argument('--model_path', help='model file for the backend (default saved_models/frozen_graph.pb for tf)')
+  parser.add_argument('--threads', type=int, help='threads per op for the tf and tflite backends (default all cores)')
+  parser.add_argument('--empty_fast_path', action='store_true', help='label flat empty squares without running the network on them')
+  parser.add_argument('--refine_certainty', type=float, default=REFINE_CERTAINTY, help='re-crop and classify again tiles below this certainty, 0 to disable (default %g)' % REFINE_CERTAINTY)
+  parser.add_argument('--server', help='prediction server to use if running (ex. http://127.0.0.1:8765), else the model is loaded locally')
+  parser.add_argument('--batch', nargs='+', metavar='INPUT', help='predict many images with one model load, inputs are folders, glob patterns, .txt lists of paths or urls, or paths and urls, writes one JSON line per image')
+  parser.add_argument('--output', default='-', help='file to write --batch or --frames JSON lines to (default stdout)')
+  parser.add_argument('--processes', type=int, help='--batch worker processes loading images and finding chessboards (default all cores)')
+  parser.add_argument('--batch_boards', type=int, default=16, help='--batch boards per inference batch (default 16)')
+  parser.add_argument('--frames', nargs='+', metavar='INPUT', help='predict the positions in the frames of an animated GIF or sequence of images of one chessboard, inputs like --batch, writes one JSON line per distinct position with the move from the previous one')
   args = parser.parse_args()
   main(args)
 
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# Tests for helper_image_loading, run with
+#   python -m unittest test_helper_image_loading
+import threading
+import time
+import unittest
+from io import BytesIO
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+except ImportError:
+  # Python 2
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+
+import PIL.Image
+
+import helper_image_loading
+
+def encodeImage(size, format):
+  """Return size image saved in format and opened again, header only"""
+  f = BytesIO()
+  PIL.Image.new('RGB', size, (120, 80, 40)).save(f, format)
+  f.seek(0)
+  return PIL.Image.open(f)
+
+class ResizeAsNeededTest(unittest.TestCase):
+  def test_large_jpeg_decodes_at_reduced_scale(self):
+    img = helper_image_loading.resizeAsNeeded(encodeImage((6000, 4500), 'JPEG'))
+    self.assertIsNotNone(img)
+    self.assertEqual(img.size, (2000, 1500))
+
+  def test_jpeg_just_over_max_size(self):
+    img = helper_image_loading.resizeAsNeeded(encodeImage((2500, 2500), 'JPEG'))
+    self.assertEqual(img.size, (2000, 2000))
+
+  def test_jpeg_over_eight_times_fail_size_rejected(self):
+    self.assertIsNone(helper_image_loading.resizeAsNeeded(
+      encodeImage((4000, 3000), 'JPEG'), max_fail_size=(400, 400)))
+
+  def test_large_png_rejected(self):
+    self.assertIsNone(helper_image_loading.resizeAsNeeded(
+      encodeImage((2500, 1000), 'PNG')))
+
+  def test_small_image_unchanged(self):
+    img = encodeImage((600, 400), 'PNG')
+    self.assertIs(helper_image_loading.resizeAsNeeded(img), img)
+
+def encodePNG(size):
+  f = BytesIO()
+  PIL.Image.new('L', size, 128).save(f, 'PNG')
+  return f.getvalue()
+
+class StandInHandler(BaseHTTPRequestHandler):
+  """Local stand-in for image hosts, the path picks the behavior"""
+  protocol_version = 'HTTP/1.1'
+  png = encodePNG((64, 48))
+
+  def log_message(self, format, *args):
+    pass
+
+  def sendHeaders(self, headers):
+    self.send_response(200)
+    for name, value in headers:
+      self.send_header(name, value)
+    self.end_headers()
+
+  def do_GET(self):
+    if self.path.startswith('/image'):
+      self.sendHeaders([('Content-Length', str(len(self.png)))])
+      self.wfile.write(self.png)
+    elif self.path == '/large_length':
+      # Claims a huge body, the client should give up before reading any
+      self.sendHeaders([('Content-Length', '999999999')])
+      self.wfile.write(b'x' * 1024)
+    elif self.path == '/large_chunked':
+      # No length up front, the body only turns out too large while streaming
+      self.sendHeaders([('Transfer-Encoding', 'chunked')])
+      try:
+        for _ in range(64):
+          self.wfile.write(b'4000\r\n' + b'y' * 0x4000 + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+      except (IOError, OSError):
+        pass # Client hung up
+    elif self.path == '/stall':
+      self.sendHeaders([('Content-Length', '1000')])
+      self.wfile.write(b'z' * 10)
+      self.wfile.flush()
+      time.sleep(3)
+    else:
+      self.send_response(404)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+  def handle_error(self, request, client_address):
+    pass # Clients hanging up on oversized bodies is expected
+
+class LoadImageFromURLTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    cls.base_url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+    thread = threading.Thread(target=cls.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+    cls.server.server_close()
+
+  def setUp(self):
+    self.read_timeout = helper_image_loading.READ_TIMEOUT
+    helper_image_loading.READ_TIMEOUT = 0.5
+
+  def tearDown(self):
+    helper_image_loading.READ_TIMEOUT = self.read_timeout
+
+  def test_image(self):
+    img, url = helper_image_loading.loadImageFromURL(self.base_url + '/image.png')
+    self.assertEqual(img.size, (64, 48))
+    self.assertEqual(url, self.base_url + '/image.png')
+
+  def test_large_content_length(self):
+    self.assertIsNone(helper_image_loading.fetchURL(
+      self.base_url + '/large_length', max_size_bytes=100000))
+
+  def test_large_chunked_body(self):
+    self.assertIsNone(helper_image_loading.fetchURL(
+      self.base_url + '/large_chunked', max_size_bytes=100000))
+
+  def test_read_timeout(self):
+    a = time.time()
+    self.assertIsNone(helper_image_loading.fetchURL(self.base_url + '/stall'))
+    self.assertLess(time.time() - a, 2.5)
+
+  def test_many_urls_in_order(self):
+    urls = [self.base_url + '/image%d.png' % i for i in range(8)]
+    urls.insert(3, self.base_url + '/missing.png')
+    results = helper_image_loading.loadImagesFromURLs(urls, max_workers=4)
+    self.assertEqual([url for _, url, _ in results], urls)
+    self.assertEqual([error is None for _, _, error in results],
+                     [url != self.base_url + '/missing.png' for url in urls])
+    self.assertIsNone(results[3][0])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 #
-# usage: tileset_generator.py [-h] input_folder output_folder
+# usage: tileset_generator.py [-h] [--processes PROCESSES]
+#                             input_folder output_folder
 
 # Generate tile images for alll chessboard images in input folder
 
 # positional arguments:
-#   input_folder   Input image folder
-#   output_folder  Output tile folder
+#   input_folder           Input image folder
+#   output_folder          Output tile folder
 
 # optional arguments:
-#   -h, --help     show this help message and exit
+#   -h, --help             show this help message and exit
+#   --processes PROCESSES  Number of worker processes (default all cores)
 
 # Pass an input folder and output folder
 # Builds tile images for each chessboard image in input folder and puts
@@ -27,17 +29,14 @@ def saveTiles(tiles, img_save_dir, img_file):
   for i in range(64):
     sqr_filename = "%s/%s_%s%d.png" % (img_save_dir, img_file, letters[i%8], i/8+1)
     
-    # Make resized 32x32 image from matrix and save
-    if tiles.shape != (32,32,64):
-      PIL.Image.fromarray(tiles[:,:,i]) \
-          .resize([32,32], PIL.Image.ADAPTIVE) \
-          .save(sqr_filename)
-    else:
-      # Possibly saving floats 0-1 needs to change fromarray settings
-      PIL.Image.fromarray((tiles[:,:,i]*255).astype(np.uint8)) \
-          .save(sqr_filename)
+    # Tiles are rows of flattened 32x32 images in rank-order A1, B1, ..., H8
+    tile = tiles[i].reshape(32,32)
+    if tile.dtype != np.uint8:
+      # Normalized floats 0-1
+      tile = (tile*255).astype(np.uint8)
+    PIL.Image.fromarray(tile).save(sqr_filename)
 
-def generateTileset(input_chessboard_folder, output_tile_folder):
+def generateTileset(input_chessboard_folder, output_tile_folder, processes=None):
   # Create output folder as needed
   if not os.path.exists(output_tile_folder):
     os.makedirs(output_tile_folder)
@@ -51,36 +50,33 @@ def generateTileset(input_chessboard_folder, output_tile_folder):
   num_failed = 0
   num_skipped = 0
 
-  for i, img_path in enumerate(img_files):
-    print("#% 3d/%d : %s" % (i+1, len(img_files), img_path))
+  img_paths = []
+  for img_path in sorted(img_files):
     # Strip to just filename
     img_file = img_path[len(input_chessboard_folder):-4]
 
-    # Create output save directory or skip this image if it exists
-    img_save_dir = "%s/tiles_%s" % (output_tile_folder, img_file)
-    
-    if os.path.exists(img_save_dir):
-      print("\tSkipping existing")
+    # Skip images whose output save directory already exists
+    if os.path.exists("%s/tiles_%s" % (output_tile_folder, img_file)):
+      print("\tSkipping existing %s" % img_path)
       num_skipped += 1
       continue
-    
-    # Load image
-    print("---")
-    print("Loading %s..." % img_path)
-    img_arr = np.array(loadImageGrayscale(img_path), dtype=np.float32)
+    img_paths.append(img_path)
 
-    # Get tiles
-    print("\tGenerating tiles for %s..." % img_file)
-    corners = findChessboardCorners(img_arr)
-    tiles = getChessTilesGray(img_arr, corners)
+  # Find chessboards and generate tiles in parallel, results come back in order
+  results = iterGrayscaleTilesInImageBatch(img_paths, dtype=np.uint8,
+                                           processes=processes)
+  for i, (img_path, (tiles, corners, error)) in enumerate(zip(img_paths, results)):
+    print("#% 3d/%d : %s" % (i+1, len(img_paths), img_path))
+    img_file = img_path[len(input_chessboard_folder):-4]
+    img_save_dir = "%s/tiles_%s" % (output_tile_folder, img_file)
 
     # Save tiles
-    if len(tiles) > 0:
+    if tiles is not None:
       print("\tSaving tiles %s" % img_file)
       saveTiles(tiles, img_save_dir, img_file)
       num_success += 1
     else:
-      print("\tNo Match, skipping")
+      print("\tNo Match, skipping%s" % (": %s" % error if error else ""))
       num_failed += 1
 
   print("\t%d/%d generated, %d failures, %d skipped." % (num_success,
@@ -93,5 +89,7 @@ if __name__ == '__main__':
                       help='Input image folder')
   parser.add_argument('output_folder', metavar='output_folder', type=str,
                       help='Output tile folder')
+  parser.add_argument('--processes', type=int, default=None,
+                      help='Number of worker processes (default all cores)')
   args = parser.parse_args()
-  generateTileset(args.input_folder, args.output_folder)
\ No newline at end of file
+  generateTileset(args.input_folder, args.output_folder, args.processes)
\ No newline at end of file